@@ -0,0 +1,102 @@
+from __future__ import division
+import math
+import time
+from array import array
+
+from metrics import Metric
+
+
+# Stands in for a batch while a collector is sampled: gauges are recorded in the
+# aggregate's buffers instead of being sent.
+class Sampler(object):
+    def __init__(self, aggregate, prefix=None):
+        self.aggregate = aggregate
+        self.prefix = prefix
+
+    def pipeline(self, prefix=None):
+        return Sampler(self.aggregate, prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        pass
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        if self.prefix and not isinstance(stat, Metric):
+            stat = '{}.{}'.format(self.prefix, stat)
+        self.aggregate.add(stat, value)
+
+
+# Fixed-size ring of the latest samples of one metric.
+class Buffer(object):
+    __slots__ = ('values', 'count', 'last')
+
+    def __init__(self, size):
+        self.values = array('d', [0.0]) * size
+        self.count = 0
+        self.last = 0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.last = value
+
+    def window(self):
+        return self.values[:min(self.count, len(self.values))]
+
+
+# Runs `collector` every sample interval and, once every `interval` seconds, sends the
+# last value of each of its gauges under the usual name, plus .min, .max, .avg and the
+# requested percentiles (.p95, .p99, ...) of the samples taken since the previous flush.
+class Aggregate(object):
+    def __init__(self, collector, interval, sample_interval, percentiles=()):
+        self.collector = collector
+        self.interval = interval
+        self.size = int(math.ceil(interval / sample_interval)) + 1
+        self.percentiles = percentiles
+        self.buffers = {}
+        self.summaries = {}  # stat -> the stats of its min, max, avg and percentiles
+        self.flushed = time.time()
+
+    def add(self, stat, value):
+        buf = self.buffers.get(stat)
+        if buf is None:
+            buf = self.buffers[stat] = Buffer(self.size)
+            self.summaries[stat] = self.summary_stats(stat)
+        buf.add(value)
+
+    def summary_stats(self, stat):
+        suffixes = ['min', 'max', 'avg'] + ['p{}'.format(p) for p in self.percentiles]
+        if isinstance(stat, Metric):
+            return [stat.child(suffix) for suffix in suffixes]
+        # Summaries go before the fields: name.max,host=...
+        name, sep, fields = stat.partition(',')
+        return ['{}.{}{}{}'.format(name, suffix, sep, fields) for suffix in suffixes]
+
+    def __call__(self, batch):
+        self.collector(Sampler(self))
+        now = time.time()
+        if now - self.flushed >= self.interval:
+            self.flushed = now
+            self.flush(batch)
+
+    def flush(self, batch):
+        for stat, buf in list(self.buffers.items()):
+            values = buf.window()
+            if not values:
+                # Not sampled since the last flush: a NIC or a disk that went away
+                del self.buffers[stat], self.summaries[stat]
+                continue
+
+            summaries = self.summaries[stat]
+            batch.gauge(stat, buf.last)
+            batch.gauge(summaries[0], min(values))
+            batch.gauge(summaries[1], max(values))
+            batch.gauge(summaries[2], sum(values) / len(values))
+            if self.percentiles:
+                ordered = sorted(values)
+                for p, summary in zip(self.percentiles, summaries[3:]):
+                    rank = max(0, int(math.ceil(p / 100 * len(ordered))) - 1)
+                    batch.gauge(summary, ordered[rank])
+            buf.count = 0
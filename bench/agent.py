@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Benchmarks run_once, each collector, StatsdConfig.get_fields and metric formatting against a
+# deterministic fake psutil (bench/fakepsutil.py) and a fake clock, sending to a local UDP
+# capture server that checks every datagram. Results are compared with bench/baseline.json:
+# a slower median cycle (beyond --tolerance), more packets, bytes or stats per cycle, or more
+# objects left behind per cycle fail the run. Timings depend on the machine: record the baseline
+# on the one that runs the comparison. Bytes depend on the python version too (str() of a float),
+# and a baseline is only compared with runs of the same major version.
+#
+#   python bench/agent.py                 # compare with the baseline
+#   python bench/agent.py --save          # record a new baseline
+#   python bench/agent.py --cpus 64 --nics 16 --only run_once
+from __future__ import division, print_function
+import argparse
+import gc
+import imp
+import json
+import os
+import sys
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+from capture import Capture, verify
+import fakepsutil
+
+sys.modules['psutil'] = fakepsutil
+
+from metrics import FORMATS, Metrics
+import rates
+import transport as transports
+
+agent = imp.load_source('statsd_agent', os.path.join(ROOT, 'statsd-agent.py'))
+
+WARMUP = 5
+INTERVAL = 10
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# os, with a steady load average
+class Os(object):
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    @staticmethod
+    def getloadavg():
+        return 0.5, 0.25, 0.125
+
+
+def benchmarks(transport, metrics):
+    config = agent.StatsdConfig(allow_no_value=True)
+    config.add_section('fields')
+    config.set('fields', 'service', 'bench')
+    config.set('fields', 'role', 'benchmark node')
+
+    def run_once():
+        agent.run_once(transport, metrics, 'eth0')
+
+    def get_fields():
+        config.get_fields(['host=bench', 'dc=eu.west'], False)
+
+    names = ['metric.{}'.format(i) for i in range(50)]
+
+    def formatting():
+        with transport.pipeline() as batch:
+            with batch.pipeline() as pipe:
+                for i in range(1000):
+                    pipe.gauge(metrics[names[i % 50]], i * 1.5)
+
+    def collector(func):
+        def run():
+            with transport.pipeline() as batch:
+                func(batch)
+        return run
+
+    yield 'run_once', run_once
+    for name, func in agent.collectors(metrics, 'eth0'):
+        yield 'collector.{}'.format(name), collector(func)
+    yield 'get_fields', get_fields
+    yield 'formatting', formatting
+
+
+def measure(func, cycles, clock, transport, capture, mtu):
+    for _ in range(WARMUP):
+        fakepsutil.tick()
+        clock.sleep(INTERVAL)
+        func()
+    capture.take(transport.packets, 0.2)
+
+    before = dict((name, getattr(transport, name)) for name in ['packets', 'bytes', 'sent'])
+    gc.collect()
+    objects = len(gc.get_objects())
+    times = []
+    for _ in range(cycles):
+        fakepsutil.tick()
+        clock.sleep(INTERVAL)
+        start = timer()
+        func()
+        times.append(timer() - start)
+    gc.collect()
+    retained = len(gc.get_objects()) - objects - 1  # the times list
+
+    packets = transport.packets - before['packets']
+    datagrams = capture.take(packets)
+    errors = verify(datagrams, mtu)
+    if len(datagrams) < packets:
+        errors.append("{} of {} datagrams received".format(len(datagrams), packets))
+
+    times.sort()
+    return {
+        'median_us': round(times[len(times) // 2] * 1e6, 1),
+        'p95_us': round(times[int(len(times) * 0.95)] * 1e6, 1),
+        'packets': packets / cycles,
+        'bytes': (transport.bytes - before['bytes']) / cycles,
+        'stats': (transport.sent - before['sent']) / cycles,
+        'retained': retained / cycles,
+    }, errors
+
+
+def regressions(result, baseline, tolerance):
+    failures = []
+    if result['median_us'] > baseline['median_us'] * (1 + tolerance):
+        failures.append("median {}us > {}us + {:.0%}".format(result['median_us'], baseline['median_us'], tolerance))
+    for key in ['packets', 'bytes', 'stats']:
+        if result[key] > baseline[key]:
+            failures.append("{} {} > {}".format(key, result[key], baseline[key]))
+    if result['retained'] > baseline['retained'] + 1:
+        failures.append("{} objects retained per cycle > {}".format(result['retained'], baseline['retained']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycles', type=int, default=200)
+    parser.add_argument('--cpus', type=int, default=4)
+    parser.add_argument('--nics', type=int, default=2)
+    parser.add_argument('--disks', type=int, default=2)
+    parser.add_argument('--mtu', type=int, default=1432)
+    parser.add_argument('--format', choices=FORMATS, default='influx', help='Wire format of the metrics.')
+    parser.add_argument('--only', type=str, help='Run only the benchmarks whose name starts with this.')
+    parser.add_argument('--baseline', type=str, default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save', action='store_true', help='Write the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed slowdown of the median cycle over the baseline (0.5 = 50%%).')
+    args = parser.parse_args()
+
+    fakepsutil.configure(cpus=args.cpus, nics=args.nics, disks=args.disks)
+    clock = Clock()
+    agent.time = rates.time = clock
+    agent.os = Os()
+
+    capture = Capture()
+    capture.start()
+    transport = transports.Transport('127.0.0.1', capture.port, mtu=args.mtu)
+    host = {'cpus': args.cpus, 'nics': args.nics, 'disks': args.disks, 'mtu': args.mtu, 'format': args.format,
+            'python': sys.version_info[0]}
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('host') != host:
+            print("baseline recorded for {}, not comparing".format(baseline.get('host')))
+            baseline = {}
+
+    results = {}
+    failed = False
+    print("{:<28} {:>10} {:>10} {:>8} {:>8} {:>8} {:>9}".format(
+        'benchmark', 'median us', 'p95 us', 'packets', 'bytes', 'stats', 'retained'))
+    for name, func in benchmarks(transport, Metrics('system', [('service', 'bench'), ('host', 'bench')], args.format)):
+        if args.only and not name.startswith(args.only):
+            continue
+        result, errors = measure(func, args.cycles, clock, transport, capture, args.mtu)
+        results[name] = result
+        if name in baseline.get('results', {}):
+            errors += regressions(result, baseline['results'][name], args.tolerance)
+        print("{:<28} {median_us:>10} {p95_us:>10} {packets:>8.1f} {bytes:>8.0f} {stats:>8.1f} {retained:>9.2f}".format(
+            name, **result))
+        for error in errors:
+            print("  FAIL: {}".format(error))
+        failed = failed or bool(errors)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'host': host, 'results': results}, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print("baseline written to {}".format(args.baseline))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
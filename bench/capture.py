@@ -0,0 +1,48 @@
+# Local UDP statsd stand-in for the benchmarks: keeps every datagram received.
+import re
+import socket
+import threading
+import time
+
+STAT = re.compile(r'^[\w.,=-]+:[+-]?[0-9.e+-]+\|(g|c|ms|s)(\|@[0-9.]+)?(\|#[\w.:,-]+)?$')
+
+
+class Capture(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 2 ** 20)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.datagrams = []
+
+    def run(self):
+        while True:
+            data = self.sock.recv(65536)
+            self.datagrams.append(data)  # the list is swapped by take()
+
+    def take(self, packets, timeout=2.0):
+        deadline = time.time() + timeout
+        while len(self.datagrams) < packets and time.time() < deadline:
+            time.sleep(0.001)
+        datagrams, self.datagrams = self.datagrams, []
+        return datagrams
+
+
+def verify(datagrams, mtu):
+    errors = []
+    for datagram in datagrams:
+        if len(datagram) > mtu:
+            errors.append("datagram of {} bytes > mtu {}".format(len(datagram), mtu))
+        for line in datagram.decode('ascii').split('\n'):
+            if not STAT.match(line):
+                errors.append("bad stat: {!r}".format(line))
+    return errors
+
+
+def stats(datagrams):
+    for datagram in datagrams:
+        for line in datagram.decode('ascii').split('\n'):
+            name, _, value = line.partition(':')
+            yield name, value
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Checks the cgroup backend (cgroup.py) against fake cgroup v1 and v2 trees built under a
+# temporary directory, with the cgroupfs and the systemd driver layouts: the stats records made
+# from its samples must hold the values written to the files, again after the files change.
+#
+#   python bench/cgroup_check.py
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+import cgroup
+import docker
+
+ID = 'c0ffee'
+PID = '4242'
+MB = 2 ** 20
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: {lo} 10 0 0 0 0 0 0 {lo} 10 0 0 0 0 0 0
+  eth0: {rx} 20 1 2 0 0 0 0 {tx} 30 3 4 0 0 0 0
+  eth1: 1000 5 0 0 0 0 0 0 2000 6 0 0 0 0 0 0
+"""
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+# The files of one container with these values, and what its stats record must then hold
+def v1_tree(root, values):
+    for controller in ['cpuacct', 'cpu', 'memory', 'blkio']:
+        path = os.path.join(root, controller, 'docker', ID)
+        if controller == 'cpu':
+            write(os.path.join(path, 'cpu.stat'), 'nr_periods {}\nnr_throttled {}\nthrottled_time 12345\n'.format(
+                values['periods'], values['throttled']))
+        elif controller == 'cpuacct':
+            write(os.path.join(path, 'cpuacct.usage'), '{}\n'.format(values['cpu']))
+            write(os.path.join(path, 'cgroup.procs'), PID + '\n')
+        elif controller == 'memory':
+            write(os.path.join(path, 'memory.usage_in_bytes'), '{}\n'.format(values['usage']))
+            write(os.path.join(path, 'memory.limit_in_bytes'), '{}\n'.format(values['limit']))
+            write(os.path.join(path, 'memory.stat'), 'cache {}\nrss {}\nrss_huge 0\nmapped_file 0\n'.format(
+                values['cache'], values['rss']))
+        else:
+            write(os.path.join(path, 'blkio.throttle.io_service_bytes'),
+                  '8:0 Read {read}\n8:0 Write {write}\n8:0 Sync 0\n8:0 Async 0\n8:0 Total {total}\n'
+                  '8:16 Read 100\n8:16 Write 200\n8:16 Total 300\nTotal {all}\n'.format(
+                      total=values['read'] + values['write'], all=values['read'] + values['write'] + 300,
+                      **values))
+    return values['read'] + 100, values['write'] + 200
+
+
+def v2_tree(root, values):
+    write(os.path.join(root, 'cgroup.controllers'), 'cpu io memory pids\n')
+    path = os.path.join(root, 'system.slice', 'docker-{}.scope'.format(ID))
+    write(os.path.join(path, 'cpu.stat'), 'usage_usec {}\nuser_usec 1\nsystem_usec 2\nnr_periods {}\nnr_throttled {}\n'
+          'throttled_usec 12\n'.format(values['cpu'] // 1000, values['periods'], values['throttled']))
+    write(os.path.join(path, 'memory.current'), '{}\n'.format(values['usage']))
+    write(os.path.join(path, 'memory.max'), 'max\n' if values['limit'] is None else '{}\n'.format(values['limit']))
+    write(os.path.join(path, 'memory.stat'), 'anon {}\nfile {}\nkernel_stack 0\n'.format(values['rss'],
+                                                                                         values['cache']))
+    write(os.path.join(path, 'io.stat'),
+          '8:0 rbytes={read} wbytes={write} rios=1 wios=2 dbytes=0 dios=0\n'
+          '8:16 rbytes=100 wbytes=200 rios=3 wios=4 dbytes=0 dios=0\n'.format(**values))
+    write(os.path.join(path, 'cgroup.procs'), PID + '\n')
+    return values['read'] + 100, values['write'] + 200
+
+
+def proc_tree(proc, values):
+    write(os.path.join(proc, PID, 'net', 'dev'), NET_DEV.format(lo=999999, **values))
+
+
+def check(name, record, values, io):
+    limit = values['limit'] or cgroup.host_memory()
+    expected = {
+        'cpu_total': values['cpu'],
+        'periods': values['periods'],
+        'throttled_periods': values['throttled'],
+        'num_cpus': multiprocessing.cpu_count(),
+        'mem_usage': values['usage'],
+        'mem_limit': min(limit, cgroup.host_memory()),
+        'mem_cache': values['cache'],
+        'mem_rss': values['rss'],
+        'read_bytes': io[0],
+        'write_bytes': io[1],
+        # eth0 and eth1, lo left out
+        'rx_bytes': values['rx'] + 1000, 'rx_packets': 25, 'rx_errors': 1, 'rx_dropped': 2,
+        'tx_bytes': values['tx'] + 2000, 'tx_packets': 36, 'tx_errors': 3, 'tx_dropped': 4,
+    }
+    errors = []
+    for key, value in sorted(expected.items()):
+        if record.get(key) != value:
+            errors.append("{}: {} is {}, not {}".format(name, key, record.get(key), value))
+    if not record['cpu_system']:
+        errors.append("{}: no cpu_system".format(name))
+    return errors
+
+
+def run(name, tree, samples):
+    base = tempfile.mkdtemp(prefix='cgroup-check-')
+    root, proc = os.path.join(base, 'cgroup'), os.path.join(base, 'proc')
+    errors = []
+    try:
+        cgroups = cgroup.Cgroups(root, proc)
+        # The files stay open between samples: the second one must see the new values
+        for values in samples:
+            io = tree(root, values)
+            proc_tree(proc, values)
+            sample = cgroups.get(ID)
+            if sample is None:
+                errors.append("{}: no sample".format(name))
+                break
+            errors += check(name, docker.stats_record(sample), values, io)
+
+        if cgroups.get('missing') is not None or cgroups.errors != 1:
+            errors.append("{}: a container without a cgroup must give no sample and count an error".format(name))
+        cgroups.sync([])
+        if cgroups.cgroups:
+            errors.append("{}: cgroups kept after sync([])".format(name))
+    finally:
+        shutil.rmtree(base)
+    print("{}: {} samples, {}".format(name, len(samples), 'FAIL' if errors else 'ok'))
+    return errors
+
+
+def main():
+    samples = [
+        dict(cpu=5 * 10 ** 9, usage=300 * MB, limit=512 * MB, cache=100 * MB, rss=180 * MB, read=4096, write=8192,
+             rx=123456, tx=654321, periods=100, throttled=7),
+        dict(cpu=7 * 10 ** 9, usage=310 * MB, limit=512 * MB, cache=90 * MB, rss=200 * MB, read=8192, write=16384,
+             rx=223456, tx=754321, periods=150, throttled=20),
+    ]
+    errors = run('v1', v1_tree, samples)
+    # "max" in memory.max is no limit: the host's memory
+    errors += run('v2', v2_tree, samples + [dict(samples[1], limit=None)])
+    for error in errors[:20]:
+        print("FAIL: {}".format(error))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
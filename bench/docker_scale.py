@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Runs run_docker against bench/fakedocker.py at several container counts and reports the docker
+# cycle time, the growth of the docker process' RSS and whether the metrics it sent match what
+# the fake containers report. Fails when any metric is off.
+#
+#   python bench/docker_scale.py --sizes 10,100,500 --mode both --latency 20 --churn 5
+from __future__ import division, print_function
+import argparse
+import imp
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+from capture import Capture
+import capture
+import fakedocker
+from metrics import Metrics
+import transport as transports
+
+agent = imp.load_source('statsd_agent', os.path.join(ROOT, 'statsd-agent.py'))
+
+SERVICE = re.compile(r'^(.*),service=bench-(\d+)$')
+
+# (metric, key of fakedocker.expected, absolute tolerance, relative tolerance)
+CHECKS = [
+    ('system.cpu.percent', 'cpu_percent', 0.5, 0.05),
+    ('system.cpu.throttled.percent', 'throttled_percent', 5, 0),
+    ('system.memory.virtual.used', 'mem_usage', 0, 0),
+    ('system.network.send_rate', 'tx_rate', 0, 0.1),
+    ('system.network.recv_rate', 'rx_rate', 0, 0.1),
+    ('system.disk.read_rate', 'read_rate', 0, 0.1),
+    ('system.disk.write_rate', 'write_rate', 0, 0.1),
+]
+
+
+def start_daemon(path, args, containers):
+    daemon = subprocess.Popen([sys.executable, os.path.join(HERE, 'fakedocker.py'), '--socket', path,
+                               '--containers', str(containers), '--cpus', str(args.cpus),
+                               '--latency', str(args.latency), '--churn', str(args.churn), '--chunked'])
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.close()
+            return daemon
+        except socket.error:
+            time.sleep(0.05)
+    daemon.kill()
+    raise RuntimeError("fake daemon did not start")
+
+
+def check(samples):
+    checked, mismatches = 0, []
+    for metric, index, value in sorted(samples):
+        for name, key, absolute, relative in CHECKS:
+            if metric != name:
+                continue
+            want = fakedocker.expected(index)[key]
+            checked += 1
+            if abs(value - want) > max(absolute, relative * want):
+                mismatches.append("bench-{} {}: {} instead of {}".format(index, metric, value, want))
+    return checked, mismatches
+
+
+def run(args, containers, stream):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'docker.sock')
+    daemon = start_daemon(path, args, containers)
+    recorder = Capture()
+    recorder.start()
+    transport = transports.Transport('127.0.0.1', recorder.port)
+    process = multiprocessing.Process(target=agent.run_docker, args=(
+        path, args.interval, transport, args.concurrency, stream, 300, None, False,
+        Metrics('agent', [('host', 'bench')])))
+    try:
+        process.start()
+        time.sleep(args.duration)
+    finally:
+        process.terminate()
+        process.join()
+        daemon.kill()
+        daemon.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    cycles, rss, seen, errors = [], [], 0, 0
+    samples = []
+    for name, value in capture.stats(recorder.take(0, 0.5)):
+        value, kind = value.split('|')[:2]
+        if name == 'agent.docker.time,host=bench':
+            cycles.append(float(value))
+        elif name == 'agent.docker.memory.rss,host=bench':
+            rss.append(float(value))
+        elif name == 'agent.docker.containers,host=bench':
+            seen = int(value)
+        elif name == 'agent.docker.errors,host=bench':
+            errors += int(value)
+        else:
+            match = SERVICE.match(name)
+            if match and kind == 'g':
+                # Every value counts, the first of each stream too
+                samples.append((match.group(1), int(match.group(2)), float(value)))
+
+    checked, mismatches = check(samples)
+    cycles.sort()
+    return {
+        'containers': containers,
+        'mode': 'stream' if stream else 'poll',
+        'cycles': len(cycles),
+        'median_ms': cycles[len(cycles) // 2] if cycles else 0,
+        'max_ms': cycles[-1] if cycles else 0,
+        'rss_start': rss[0] / 2 ** 20 if rss else 0,
+        'rss_end': rss[-1] / 2 ** 20 if rss else 0,
+        'seen': seen,
+        'errors': errors,
+        'checked': checked,
+        'mismatches': mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='10,100,500', help='Comma separated container counts.')
+    parser.add_argument('--mode', choices=['poll', 'stream', 'both'], default='both')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to run each size and mode.')
+    parser.add_argument('--interval', type=int, default=3, help='Docker interval of the agent.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--cpus', type=int, default=64, help='Length of the percpu_usage arrays.')
+    parser.add_argument('--latency', type=float, default=10, help='Milliseconds before each daemon response.')
+    parser.add_argument('--churn', type=float, default=0, help='Seconds between container replacements.')
+    args = parser.parse_args()
+
+    modes = [False, True] if args.mode == 'both' else [args.mode == 'stream']
+    print("{:>10} {:>6} {:>6} {:>10} {:>10} {:>9} {:>9} {:>5} {:>6} {:>8} {:>10}".format(
+        'containers', 'mode', 'cycles', 'median ms', 'max ms', 'rss MiB', 'end MiB', 'seen', 'errors', 'checked',
+        'mismatches'))
+    failed = False
+    for containers in [int(size) for size in args.sizes.split(',')]:
+        for stream in modes:
+            result = run(args, containers, stream)
+            print("{containers:>10} {mode:>6} {cycles:>6} {median_ms:>10.1f} {max_ms:>10.1f} {rss_start:>9.1f} "
+                  "{rss_end:>9.1f} {seen:>5} {errors:>6} {checked:>8} {0:>10}".format(len(result['mismatches']),
+                                                                                    **result))
+            for mismatch in result['mismatches'][:10]:
+                print("  {}".format(mismatch))
+            failed = failed or bool(result['mismatches'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Fake docker daemon on a Unix socket, for load testing run_docker. It serves /containers/json,
+# /containers/{id}/stats (stream=0 and stream=1) and /events for --containers synthetic
+# containers. With --churn, a random container dies and a new one starts every that many seconds.
+#
+# Container bench-<i> reports values bench/docker_scale.py can check:
+#   cpu.percent (i % 8) + 1, cpu.throttled.percent (i % 3) * 10, memory used (i + 1) MiB out of 1 GiB,
+#   network send (i + 1) * 500 B/s and recv (i + 1) * 1000 B/s, disk read (i + 1) * 4096 B/s and
+#   write (i + 1) * 2048 B/s.
+#
+#   python bench/fakedocker.py --socket /tmp/docker.sock --containers 500 --latency 50 --cpus 64
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from Queue import Queue
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from queue import Queue
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+
+MIB = 2 ** 20
+STATS = re.compile(r'^/(?:v[\d.]+/)?containers/([0-9a-f]+)/stats$')
+
+
+def expected(i):
+    return {
+        'cpu_percent': (i % 8) + 1,
+        'throttled_percent': (i % 3) * 10,
+        'mem_usage': (i + 1) * MIB,
+        'mem_limit': 1024 * MIB,
+        'tx_rate': (i + 1) * 500,
+        'rx_rate': (i + 1) * 1000,
+        'read_rate': (i + 1) * 4096,
+        'write_rate': (i + 1) * 2048,
+    }
+
+
+def timestamp(now):
+    return '{}.{:09d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)), int(now % 1 * 1e9))
+
+
+class Container(object):
+    def __init__(self, index, started):
+        self.index = index
+        self.id = '{:064x}'.format(random.getrandbits(256))
+        self.name = 'bench-{}'.format(index)
+        self.started = started
+        self.running = True
+
+    def summary(self):
+        return {
+            'Id': self.id, 'Names': ['/' + self.name], 'Image': 'bench', 'Command': 'sleep infinity',
+            'Created': int(self.started), 'State': 'running',
+            'Status': 'Up {} seconds'.format(int(time.time() - self.started)),
+            'Labels': {'com.example.bench': 'true'}, 'Ports': [],
+        }
+
+    def cpu_stats(self, now, cpus):
+        t = now - self.started
+        total = int(t * ((self.index % 8) + 1) * 1e7)
+        return {
+            'cpu_usage': {'total_usage': total, 'percpu_usage': [total // cpus] * cpus,
+                          'usage_in_kernelmode': total // 4, 'usage_in_usermode': total - total // 4},
+            'system_cpu_usage': int(now * cpus * 1e9),
+            'online_cpus': cpus,
+            'throttling_data': {'periods': int(t * 10), 'throttled_periods': int(t * (self.index % 3)),
+                                'throttled_time': 0},
+        }
+
+    # The first frame of a stream has no previous sample, like the daemon's: empty precpu_stats
+    def stats(self, now, cpus, first=False):
+        t = now - self.started
+        i = self.index
+        usage = (i + 1) * MIB
+        read, write = int(t * (i + 1) * 4096), int(t * (i + 1) * 2048)
+        return {
+            'read': timestamp(now),
+            'preread': '0001-01-01T00:00:00Z' if first else timestamp(now - 1),
+            'pids_stats': {'current': 3},
+            'num_procs': 0,
+            'cpu_stats': self.cpu_stats(now, cpus),
+            'precpu_stats': {'cpu_usage': {'total_usage': 0, 'usage_in_kernelmode': 0, 'usage_in_usermode': 0},
+                             'throttling_data': {'periods': 0, 'throttled_periods': 0, 'throttled_time': 0}}
+            if first else self.cpu_stats(now - 1, cpus),
+            'memory_stats': {
+                'usage': usage, 'max_usage': usage, 'limit': 1024 * MIB,
+                'stats': {'cache': usage // 4, 'rss': usage // 2, 'mapped_file': 0, 'pgfault': int(t * 100),
+                          'active_anon': usage // 2, 'inactive_file': usage // 8, 'total_rss': usage // 2},
+            },
+            'networks': {
+                'eth0': {'rx_bytes': int(t * (i + 1) * 1000), 'rx_packets': int(t * 10), 'rx_errors': 0,
+                         'rx_dropped': 0, 'tx_bytes': int(t * (i + 1) * 500), 'tx_packets': int(t * 5),
+                         'tx_errors': 0, 'tx_dropped': 0},
+            },
+            'blkio_stats': {
+                'io_service_bytes_recursive': [
+                    {'major': 8, 'minor': 0, 'op': 'Read', 'value': read},
+                    {'major': 8, 'minor': 0, 'op': 'Write', 'value': write},
+                    {'major': 8, 'minor': 0, 'op': 'Sync', 'value': write},
+                    {'major': 8, 'minor': 0, 'op': 'Async', 'value': read},
+                    {'major': 8, 'minor': 0, 'op': 'Total', 'value': read + write},
+                ],
+                'io_serviced_recursive': [], 'io_queue_recursive': [], 'io_service_time_recursive': [],
+                'io_wait_time_recursive': [], 'io_merged_recursive': [], 'io_time_recursive': [],
+                'sectors_recursive': [],
+            },
+            'storage_stats': {},
+            'name': '/' + self.name,
+            'id': self.id,
+        }
+
+
+class Daemon(object):
+    def __init__(self, containers, cpus, churn):
+        self.cpus = cpus
+        self.churn = churn
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.containers = {}
+        self.subscribers = []
+        for _ in range(containers):
+            self.start_container()
+
+    def start_container(self):
+        with self.lock:
+            container = Container(self.next_index, time.time())
+            self.next_index += 1
+            self.containers[container.id] = container
+        self.publish('start', container)
+
+    def kill_container(self):
+        with self.lock:
+            if not self.containers:
+                return
+            container = self.containers.pop(random.choice(list(self.containers)))
+            container.running = False
+        self.publish('die', container)
+
+    def publish(self, action, container):
+        now = time.time()
+        event = {'status': action, 'id': container.id, 'from': 'bench', 'Type': 'container', 'Action': action,
+                 'Actor': {'ID': container.id, 'Attributes': {'name': container.name, 'image': 'bench'}},
+                 'time': int(now), 'timeNano': int(now * 1e9)}
+        with self.lock:
+            for queue in self.subscribers:
+                queue.put(event)
+
+    def run_churn(self):
+        while True:
+            time.sleep(self.churn)
+            self.kill_container()
+            self.start_container()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def send_json(self, status, document):
+        time.sleep(self.server.latency)
+        body = json.dumps(document)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.chunked and self.request_version != 'HTTP/1.0':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            # Like the daemon: the document and its newline, then the end
+            self.wfile.write('{:x}\r\n{}\n\r\n0\r\n\r\n'.format(len(body) + 1, body).encode('utf-8'))
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+    def send_stream(self, documents):
+        # The requests of run_docker's streams are HTTP/1.0: the body ends with the connection
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for document in documents:
+                self.wfile.write((json.dumps(document) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+
+    def do_GET(self):
+        docker = self.server.docker
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = re.sub(r'^/v[\d.]+', '', url.path)
+
+        if path == '/containers/json':
+            with docker.lock:
+                containers = [container.summary() for container in docker.containers.values()]
+            return self.send_json(200, containers)
+
+        if path == '/events':
+            queue = Queue()
+            with docker.lock:
+                docker.subscribers.append(queue)
+            try:
+                self.send_stream(iter(queue.get, None))
+            finally:
+                with docker.lock:
+                    docker.subscribers.remove(queue)
+            return
+
+        match = STATS.match(path)
+        if match:
+            with docker.lock:
+                container = docker.containers.get(match.group(1))
+            if container is None:
+                return self.send_json(404, {'message': 'No such container: {}'.format(match.group(1))})
+            if query.get('stream', ['1'])[0] in ('0', 'false'):
+                return self.send_json(200, container.stats(time.time(), docker.cpus))
+
+            def stream():
+                first = True
+                while container.running:
+                    yield container.stats(time.time(), docker.cpus, first)
+                    first = False
+                    time.sleep(self.server.interval)
+            return self.send_stream(stream())
+
+        self.send_json(404, {'message': 'page not found'})
+
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default='/tmp/fakedocker.sock')
+    parser.add_argument('--containers', type=int, default=100)
+    parser.add_argument('--cpus', type=int, default=64, help='Length of the percpu_usage arrays.')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds before each response.')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between streamed stats.')
+    parser.add_argument('--churn', type=float, default=0, help='Seconds between container replacements.')
+    parser.add_argument('--chunked', action='store_true', help='Send the responses chunked, like dockerd.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = Server(args.socket, Handler)
+    server.docker = Daemon(args.containers, args.cpus, args.churn)
+    server.latency = args.latency / 1000
+    server.interval = args.interval
+    server.chunked = args.chunked
+    if args.churn > 0:
+        churn = threading.Thread(target=server.docker.run_churn)
+        churn.daemon = True
+        churn.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Deterministic stand-in for the parts of psutil the collectors use. Every value is a function
+# of the current tick, advanced with tick(), and of the host shape given to configure().
+from __future__ import division
+import socket
+from collections import namedtuple
+
+__version__ = 'fake'
+
+scputimes = namedtuple('scputimes', ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal',
+                                     'guest', 'guest_nice'])
+snetio = namedtuple('snetio', ['bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv', 'errin', 'errout',
+                               'dropin', 'dropout'])
+sdiskio = namedtuple('sdiskio', ['read_count', 'write_count', 'read_bytes', 'write_bytes', 'read_time',
+                                 'write_time', 'read_merged_count', 'write_merged_count', 'busy_time'])
+sdiskusage = namedtuple('sdiskusage', ['total', 'used', 'free', 'percent'])
+svmem = namedtuple('svmem', ['total', 'available', 'percent', 'used', 'free', 'active', 'inactive', 'buffers',
+                             'cached', 'shared'])
+sswap = namedtuple('sswap', ['total', 'used', 'free', 'percent', 'sin', 'sout'])
+suser = namedtuple('suser', ['name', 'terminal', 'host', 'started'])
+snicaddr = namedtuple('snicaddr', ['family', 'address', 'netmask', 'broadcast', 'ptp'])
+
+
+class Error(Exception):
+    pass
+
+
+class NoSuchProcess(Error):
+    pass
+
+
+class AccessDenied(Error):
+    pass
+
+
+class ZombieProcess(NoSuchProcess):
+    pass
+
+
+host = {'cpus': 4, 'nics': 2, 'disks': 2, 'pids': 300, 'tick': 0}
+
+
+def configure(cpus=4, nics=2, disks=2, pids=300):
+    host.update(cpus=cpus, nics=nics, disks=disks, pids=pids, tick=0)
+
+
+def tick():
+    host['tick'] += 1
+
+
+def nic_names():
+    return ['eth{}'.format(i) for i in range(host['nics'])]
+
+
+def cpu_count(logical=True):
+    return host['cpus']
+
+
+def _cpu(i):
+    t = host['tick'] + 1
+    return scputimes(user=t * 3.5 + i, nice=t * 0.1, system=t * 1.25 + i, idle=t * 4.75, iowait=t * 0.25,
+                     irq=t * 0.05, softirq=t * 0.05, steal=0.0, guest=0.0, guest_nice=0.0)
+
+
+def cpu_times(percpu=False):
+    cpus = [_cpu(i) for i in range(host['cpus'])]
+    if percpu:
+        return cpus
+    return scputimes(*[sum(values) for values in zip(*cpus)])
+
+
+def net_io_counters(pernic=False):
+    t = host['tick'] + 1
+    nics = dict((name, snetio(bytes_sent=t * 125000 * (i + 1), bytes_recv=t * 250000 * (i + 1),
+                              packets_sent=t * 100 * (i + 1), packets_recv=t * 200 * (i + 1),
+                              errin=t // 10, errout=t // 20, dropin=t // 5, dropout=0))
+                for i, name in enumerate(nic_names()))
+    if pernic:
+        return nics
+    return snetio(*[sum(values) for values in zip(*nics.values())])
+
+
+def net_if_addrs():
+    return dict((name, [snicaddr(socket.AF_INET, '10.0.{}.1'.format(i), '255.255.255.0', None, None)])
+                for i, name in enumerate(nic_names()))
+
+
+def disk_io_counters(perdisk=False):
+    t = host['tick'] + 1
+    disks = dict(('sd{}'.format(chr(ord('a') + i)),
+                  sdiskio(read_count=t * 50, write_count=t * 80, read_bytes=t * 409600, write_bytes=t * 819200,
+                          read_time=t * 30, write_time=t * 60, read_merged_count=t, write_merged_count=t,
+                          busy_time=t * 70))
+                 for i in range(host['disks']))
+    if perdisk:
+        return disks
+    return sdiskio(*[sum(values) for values in zip(*disks.values())])
+
+
+def disk_usage(path):
+    used = 40 * 2 ** 30 + host['tick'] * 4096
+    return sdiskusage(total=100 * 2 ** 30, used=used, free=100 * 2 ** 30 - used, percent=40.0)
+
+
+def virtual_memory():
+    used = 6 * 2 ** 30 + (host['tick'] % 7) * 2 ** 20
+    return svmem(total=16 * 2 ** 30, available=16 * 2 ** 30 - used, percent=round(100.0 * used / 16 / 2 ** 30, 1),
+                 used=used, free=2 * 2 ** 30, active=5 * 2 ** 30, inactive=3 * 2 ** 30, buffers=2 ** 28,
+                 cached=4 * 2 ** 30, shared=2 ** 26)
+
+
+def swap_memory():
+    return sswap(total=2 ** 31, used=0, free=2 ** 31, percent=0.0, sin=0, sout=0)
+
+
+def boot_time():
+    return 1000000000.0
+
+
+def users():
+    return [suser('root', 'pts/0', None, 1000000000.0)]
+
+
+def pids():
+    return list(range(1, host['pids'] + 1))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Stand-in statsd server: prints every stat received over udp, tcp or a unix datagram socket,
+# or with --count, the number of stats received each second.
+#
+#   python bench/listener.py --transport tcp --port 8125
+#   python bench/listener.py --transport unix --path /tmp/statsite.sock --count
+from __future__ import print_function
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+
+class Counter(object):
+    def __init__(self, count):
+        self.count = count
+        self.stats = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def received(self, data):
+        lines = [line for line in data.decode('ascii', 'replace').split('\n') if line]
+        with self.lock:
+            self.stats += len(lines)
+            self.total += len(lines)
+        if not self.count:
+            for line in lines:
+                print(line)
+            sys.stdout.flush()
+
+    def report(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                stats, self.stats = self.stats, 0
+            print("{} stats/s, {} total".format(stats, self.total))
+            sys.stdout.flush()
+
+
+def datagrams(sock, counter):
+    while True:
+        counter.received(sock.recv(65536))
+
+
+def stream(conn, counter):
+    pending = b''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        # Only whole lines
+        data, _, pending = (pending + data).rpartition(b'\n')
+        counter.received(data)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', choices=['udp', 'tcp', 'unix'], default='udp')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8125)
+    parser.add_argument('--path', default='/tmp/statsite.sock', help='Socket path for unix.')
+    parser.add_argument('--count', action='store_true', help='Only print the number of stats per second.')
+    args = parser.parse_args()
+
+    counter = Counter(args.count)
+    if args.count:
+        reporter = threading.Thread(target=counter.report)
+        reporter.daemon = True
+        reporter.start()
+
+    if args.transport == 'unix':
+        if os.path.exists(args.path):
+            os.unlink(args.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(args.path)
+        datagrams(sock, counter)
+    elif args.transport == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.host, args.port))
+        datagrams(sock, counter)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((args.host, args.port))
+        sock.listen(16)
+        while True:
+            conn, _ = sock.accept()
+            thread = threading.Thread(target=stream, args=(conn, counter))
+            thread.daemon = True
+            thread.start()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
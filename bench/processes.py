@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Times one update of the process table against the way it would be done without caching
+# (a new psutil.Process and separate reads per PID on every cycle), with extra idle processes
+# spawned to get to a busy host's PID count.
+#
+#   python bench/processes.py --spawn 2000 --cycles 10 --top 5
+from __future__ import division, print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psutil
+
+from processes import ProcessTable
+
+
+def uncached():
+    results = []
+    for pid in psutil.pids():
+        try:
+            process = psutil.Process(pid)
+            times = process.cpu_times()
+            results.append((process.name(), times.user + times.system, process.memory_info().rss))
+        except psutil.Error:
+            pass
+    return results
+
+
+def timed(func, cycles):
+    times = []
+    for _ in range(cycles):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawn', type=int, default=2000, help='Idle processes to start first.')
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    children = []
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(args.spawn):
+                children.append(subprocess.Popen(['sleep', '3600'], stdout=devnull, stderr=devnull))
+
+        pids = len(psutil.pids())
+        table = ProcessTable()
+        table.update()  # the first update fills the table
+
+        def cached():
+            table.update()
+            table.top_cpu(args.top)
+            table.top_rss(args.top)
+
+        print("{} pids, psutil {}".format(pids, psutil.__version__))
+        for name, func in [('uncached', uncached), ('cached', cached)]:
+            best, mean = timed(func, args.cycles)
+            print("{:>8}: best {:7.1f}ms  mean {:7.1f}ms  ({:.1f}us/pid)".format(
+                name, best * 1000, mean * 1000, best * 1e6 / pids))
+        print("top cpu: {}".format(table.top_cpu(args.top)))
+        print("top rss: {}".format(table.top_rss(args.top)))
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Checks the proc backend (procfs.py) against psutil on this host, then times both. Every value
+# procfs returns must be between two psutil reads taken around it: the same or higher for
+# counters, within --slack of either for memory. The collectors must send the same metric
+# names with either backend, and --threads threads sharing one ProcFS must all get whole
+# answers, as the collectors the scheduler runs at the same tick do. Linux only.
+#
+#   python bench/procfs_parity.py --rounds 200 --threads 4
+from __future__ import division, print_function
+import argparse
+import imp
+import os
+import sys
+import threading
+import time
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+import psutil
+from capture import Capture
+import capture
+from metrics import Metrics
+import procfs
+import transport as transports
+
+agent = imp.load_source('statsd_agent', os.path.join(ROOT, 'statsd-agent.py'))
+
+# (call, arguments, whether its values only grow)
+CALLS = [
+    ('cpu_times', (), True),
+    ('cpu_times', (True,), True),
+    ('virtual_memory', (), False),
+    ('swap_memory', (), False),
+    ('disk_io_counters', (False,), True),
+    ('boot_time', (), False),
+]
+
+
+def compare(name, before, value, after, counter, slack):
+    if isinstance(value, list):  # per CPU
+        if not len(before) == len(value) == len(after):
+            return ["{}: {} values, psutil has {}".format(name, len(value), len(before))]
+        return sum([compare('{}[{}]'.format(name, i), b, v, a, counter, slack)
+                    for i, (b, v, a) in enumerate(zip(before, value, after))], [])
+    errors = []
+    if name == 'boot_time':
+        before, value, after = [before], [value], [after]
+    fields = getattr(value, '_fields', [name])
+    for field, got in zip(fields, value):
+        low, high = (before[0], after[0]) if name == 'boot_time' else (getattr(before, field), getattr(after, field))
+        if counter:
+            ok = low - 1e-6 <= got <= high + 1e-6
+        else:
+            tolerance = 0.5 if field == 'percent' else slack
+            ok = min(low, high) - tolerance <= got <= max(low, high) + tolerance
+        if not ok:
+            errors.append("{}.{}: {} not between psutil's {} and {}".format(name, field, got, low, high))
+    return errors
+
+
+def values(proc, rounds, slack):
+    errors = []
+    for _ in range(rounds):
+        for name, args, counter in CALLS:
+            before = getattr(psutil, name)(*args)
+            value = getattr(proc, name)(*args)
+            after = getattr(psutil, name)(*args)
+            errors += compare(name, before, value, after, counter, slack)
+
+        before = psutil.net_io_counters(True)
+        nics = proc.net_io_counters(True)
+        after = psutil.net_io_counters(True)
+        if set(nics) != set(before):
+            errors.append("net_io_counters: NICs {} instead of {}".format(sorted(nics), sorted(before)))
+        for nic in set(nics) & set(before) & set(after):
+            errors += compare('net_io_counters[{}]'.format(nic), before[nic], nics[nic], after[nic], True, slack)
+
+        pids = len(proc.pids())
+        if abs(pids - len(psutil.pids())) > 10:
+            errors.append("pids: {} instead of {}".format(pids, len(psutil.pids())))
+    return errors
+
+
+# Whole answers: every CPU, every NIC, counters that never go back
+def concurrent(proc, threads, rounds):
+    cpus = psutil.cpu_count()
+    nics = len(psutil.net_io_counters(True))
+    errors = []
+
+    def run():
+        last = None
+        for _ in range(rounds):
+            try:
+                times = proc.cpu_times()
+                percpu = proc.cpu_times(True)
+                memory = proc.virtual_memory()
+                disks = proc.disk_io_counters()
+                found = len(proc.net_io_counters(True))
+            except Exception as e:
+                errors.append("concurrent: {!r}".format(e))
+                return
+            if len(percpu) != cpus:
+                errors.append("concurrent: {} CPUs instead of {}".format(len(percpu), cpus))
+            if found != nics:
+                errors.append("concurrent: {} NICs instead of {}".format(found, nics))
+            if not memory.total:
+                errors.append("concurrent: no memory")
+            if last is not None and (times.user < last[0].user or disks.read_count < last[1].read_count):
+                errors.append("concurrent: counters went back from {} to {}".format(last, (times, disks)))
+            last = times, disks
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return errors
+
+
+def metric_names(backend, transport, recorder, nic):
+    agent.sysinfo = backend
+    agent.prev_cpu_times = None
+    for _ in range(2):  # the second run has rates and percentages
+        agent.run_once(transport, Metrics('system', [('host', 'parity')]), nic)
+        time.sleep(0.1)  # for the CPU times to move
+    return set(name for name, _ in capture.stats(recorder.take(transport.packets, 1.0)))
+
+
+def timings(proc, calls):
+    print("{:<24} {:>10} {:>10}".format('call', 'psutil us', 'proc us'))
+    for name, args, _ in CALLS + [('net_io_counters', (True,), True), ('pids', (), False)]:
+        row = []
+        for backend in [psutil, proc]:
+            func = getattr(backend, name)
+            start = timer()
+            for _ in range(calls):
+                func(*args)
+            row.append((timer() - start) / calls * 1e6)
+        label = '{}({})'.format(name, ', '.join(str(arg) for arg in args)) if args else name
+        print("{:<24} {:>10.1f} {:>10.1f}".format(label, *row))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--calls', type=int, default=1000, help='Calls of each function to time.')
+    parser.add_argument('--slack', type=int, default=4 * 2 ** 20,
+                        help='Bytes memory may move by between the psutil and the procfs reads.')
+    parser.add_argument('--threads', type=int, default=4, help='Threads calling one ProcFS at once.')
+    parser.add_argument('--nic', type=str, default='lo', help='NIC the collectors treat as the main one.')
+    args = parser.parse_args()
+
+    proc = procfs.ProcFS()
+    errors = values(proc, args.rounds, args.slack)
+    errors += concurrent(proc, args.threads, args.rounds * 10)
+
+    recorder = Capture()
+    recorder.start()
+    transport = transports.Transport('127.0.0.1', recorder.port)
+    names = metric_names(psutil, transport, recorder, args.nic)
+    proc_names = metric_names(proc, transport, recorder, args.nic)
+    # NICs and disks may come and go in between, but not whole metrics
+    strip = lambda names: set(name.split(',')[0] for name in names)
+    if strip(names) != strip(proc_names):
+        errors.append("metrics only with psutil: {}, only with proc: {}".format(
+            sorted(strip(names) - strip(proc_names)), sorted(strip(proc_names) - strip(names))))
+    print("{} rounds, {} metrics from each backend".format(args.rounds, len(names)))
+
+    timings(proc, args.calls)
+    for error in errors[:20]:
+        print("FAIL: {}".format(error))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
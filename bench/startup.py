@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Times statsd-agent.py --once from process start to exit, less its --once-window, sending to
+# a local UDP capture server, and fails when the median run is slower than --max-ms. The agent
+# runs from an empty directory so that no statsd-agent.cfg is read.
+#
+#   python bench/startup.py --runs 20 --window 0
+from __future__ import division, print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+
+from capture import Capture
+import capture
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--window', type=float, default=0, help='--once-window of the agent.')
+    parser.add_argument('--nic', type=str, default='lo', help='NIC the agent measures.')
+    parser.add_argument('--max-ms', type=float, default=250, help='Slowest acceptable median run.')
+    args = parser.parse_args()
+
+    recorder = Capture()
+    recorder.start()
+    command = [sys.executable, os.path.join(ROOT, 'statsd-agent.py'), '--once', '--once-window', str(args.window),
+               '--host', '127.0.0.1', '--port', str(recorder.port), '--network', args.nic, '--prefix', 'system']
+    cwd = tempfile.mkdtemp()
+    times, stats = [], []
+    try:
+        for _ in range(args.runs):
+            start = timer()
+            code = subprocess.call(command, cwd=cwd)
+            times.append(timer() - start - args.window)  # the agent sleeps through its window
+            if code != 0:
+                print("statsd-agent.py exited with {}".format(code))
+                return 1
+            time.sleep(0.02)  # for the capture thread to read the last datagrams
+            stats.append(len(list(capture.stats(recorder.take(1, 1.0)))))
+    finally:
+        shutil.rmtree(cwd, ignore_errors=True)
+
+    times.sort()
+    median = times[len(times) // 2] * 1000
+    print("{} runs: median {:.1f}ms, min {:.1f}ms, max {:.1f}ms, {} to {} stats per run".format(
+        args.runs, median, times[0] * 1000, times[-1] * 1000, min(stats), max(stats)))
+    if median > args.max_ms:
+        print("FAIL: median {:.1f}ms > {}ms".format(median, args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
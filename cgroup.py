@@ -0,0 +1,207 @@
+import multiprocessing
+import os
+import time
+
+from common import log
+
+ROOT = '/sys/fs/cgroup'
+PROC = '/proc'
+
+# Where docker puts a container's cgroup with the cgroupfs and the systemd cgroup drivers
+PARENTS = ['docker/{}', 'system.slice/docker-{}.scope']
+
+MAX_LIMIT = 2 ** 62  # "no limit" in cgroup v1
+
+
+def find(base, id_):
+    for parent in PARENTS:
+        path = os.path.join(base, parent.format(id_))
+        if os.path.isdir(path):
+            return path
+    raise IOError("no cgroup for {} under {}".format(id_[:12], base))
+
+
+def read(f):
+    f.seek(0)
+    return f.read()
+
+
+def cpu_stat(f):
+    return dict((key, int(value)) for key, value in (line.split() for line in read(f).splitlines()))
+
+
+def host_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+# One container's cgroup files, opened once and re-read with seek(0) on every sample.
+# sample() returns the subset of a docker stats document that run_docker uses.
+class Cgroup(object):
+    def __init__(self, id_, root=ROOT, proc=PROC):
+        self.id = id_
+        self.proc = proc
+        self.v2 = os.path.exists(os.path.join(root, 'cgroup.controllers'))
+        self._files = []
+        self._net = None
+        self._throttling = None  # v1: the cpu controller's cpu.stat, when there is one
+
+        try:
+            if self.v2:
+                path = find(root, id_)
+                self._cpu = self._open(path, 'cpu.stat')
+                self._mem = self._open(path, 'memory.current')
+                self._limit = self._open(path, 'memory.max')
+                self._mem_stat = self._open(path, 'memory.stat')
+                self._io = self._open(path, 'io.stat')
+                self._procs = self._open(path, 'cgroup.procs')
+            else:
+                cpuacct = find(os.path.join(root, 'cpuacct'), id_)
+                memory = find(os.path.join(root, 'memory'), id_)
+                self._cpu = self._open(cpuacct, 'cpuacct.usage')
+                self._mem = self._open(memory, 'memory.usage_in_bytes')
+                self._limit = self._open(memory, 'memory.limit_in_bytes')
+                self._mem_stat = self._open(memory, 'memory.stat')
+                self._io = self._open(find(os.path.join(root, 'blkio'), id_), 'blkio.throttle.io_service_bytes')
+                self._procs = self._open(cpuacct, 'cgroup.procs')
+                try:
+                    self._throttling = self._open(find(os.path.join(root, 'cpu'), id_), 'cpu.stat')
+                except (IOError, OSError):
+                    pass
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def _open(self, path, name):
+        f = open(os.path.join(path, name))
+        self._files.append(f)
+        return f
+
+    # The CPU time used (ns), and the CFS periods and throttled periods, None without the cpu
+    # controller's cpu.stat (v1)
+    def cpu(self):
+        if self.v2:
+            stat = cpu_stat(self._cpu)
+            return stat.get('usage_usec', 0) * 1000, stat.get('nr_periods', 0), stat.get('nr_throttled', 0)
+        if self._throttling is None:
+            return int(read(self._cpu)), None, None
+        stat = cpu_stat(self._throttling)
+        return int(read(self._cpu)), stat.get('nr_periods', 0), stat.get('nr_throttled', 0)
+
+    def memory(self):
+        usage = int(read(self._mem))
+        limit = read(self._limit).strip()
+        limit = int(limit) if limit != 'max' else MAX_LIMIT
+        return usage, min(limit, host_memory())
+
+    def memory_stats(self):
+        # Same keys as the docker API: cache/rss (v1) or file/anon (v2)
+        stats = {}
+        for line in read(self._mem_stat).splitlines():
+            key, value = line.split()
+            if key in ('cache', 'rss', 'file', 'anon'):
+                stats[key] = int(value)
+        return stats
+
+    def io_service_bytes(self):
+        read_bytes = write_bytes = 0
+        for line in read(self._io).splitlines():
+            if self.v2:
+                # 8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0
+                for pair in line.split()[1:]:
+                    key, value = pair.split('=', 1)
+                    if key == 'rbytes':
+                        read_bytes += int(value)
+                    elif key == 'wbytes':
+                        write_bytes += int(value)
+            else:
+                # 8:0 Read 123 (one line per device and operation, then "Total 456")
+                parts = line.split()
+                if len(parts) == 3 and parts[1] == 'Read':
+                    read_bytes += int(parts[2])
+                elif len(parts) == 3 and parts[1] == 'Write':
+                    write_bytes += int(parts[2])
+        return [{'op': 'Read', 'value': read_bytes}, {'op': 'Write', 'value': write_bytes}]
+
+    def networks(self):
+        # The container's interfaces are only visible from inside its network namespace
+        if self._net is None:
+            pids = read(self._procs).split()
+            try:
+                self._net = open(os.path.join(self.proc, pids[0], 'net', 'dev'))
+            except (IndexError, IOError):
+                return {}
+
+        try:
+            text = read(self._net)
+        except IOError:
+            text = ''
+        if not text:
+            self._net.close()
+            self._net = None
+            return {}
+
+        networks = {}
+        for line in text.splitlines()[2:]:
+            nic, counters = line.split(':', 1)
+            nic, counters = nic.strip(), counters.split()
+            if nic != 'lo':
+                networks[nic] = {'rx_bytes': int(counters[0]), 'rx_packets': int(counters[1]),
+                                 'rx_errors': int(counters[2]), 'rx_dropped': int(counters[3]),
+                                 'tx_bytes': int(counters[8]), 'tx_packets': int(counters[9]),
+                                 'tx_errors': int(counters[10]), 'tx_dropped': int(counters[11])}
+        return networks
+
+    def sample(self):
+        num_cpus = multiprocessing.cpu_count()
+        usage, limit = self.memory()
+        cpu, periods, throttled = self.cpu()
+        cpu_stats = {
+            'cpu_usage': {'total_usage': cpu},
+            # Wall clock time of all CPUs, so that usage / system * online_cpus is the share of one CPU
+            'system_cpu_usage': int(time.time() * 1e9) * num_cpus,
+            'online_cpus': num_cpus,
+        }
+        if periods is not None:
+            cpu_stats['throttling_data'] = {'periods': periods, 'throttled_periods': throttled}
+        return {
+            'cpu_stats': cpu_stats,
+            'memory_stats': {'usage': usage, 'limit': limit, 'stats': self.memory_stats()},
+            'blkio_stats': {'io_service_bytes_recursive': self.io_service_bytes()},
+            'networks': self.networks(),
+        }
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        if self._net is not None:
+            self._net.close()
+        self._files, self._net = [], None
+
+
+class Cgroups(object):
+    def __init__(self, root=ROOT, proc=PROC):
+        self.root = root
+        self.proc = proc
+        self.cgroups = {}
+        self.errors = 0
+
+    def sync(self, ids):
+        for id_ in set(self.cgroups) - set(ids):
+            self.cgroups.pop(id_).close()
+
+    def get(self, id_):
+        try:
+            cgroup = self.cgroups.get(id_)
+            if cgroup is None:
+                cgroup = self.cgroups[id_] = Cgroup(id_, self.root, self.proc)
+            return cgroup.sample()
+        except (IOError, OSError, ValueError) as e:
+            self.errors += 1
+            log.error("{}: cgroup: {}".format(id_[:12], e))
+            cgroup = self.cgroups.pop(id_, None)
+            if cgroup is not None:
+                cgroup.close()
+            return None
+
+    def close(self):
+        self.sync([])
@@ -0,0 +1,88 @@
+from __future__ import division
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PERCENTILES = [90]
+
+
+# Busy and total time of each core in psutil.cpu_times(percpu=True), counted like
+# cpu_times_percent does: guest time is already in user time, idle and iowait are not busy.
+def core_times(percpu):
+    fields = percpu[0]._fields
+    idle = [fields.index(name) for name in ('idle', 'iowait') if name in fields]
+    guest = [fields.index(name) for name in ('guest', 'guest_nice') if name in fields]
+    if numpy is not None:
+        times = numpy.array(percpu, dtype=float)
+        total = times.sum(axis=1) - times[:, guest].sum(axis=1)
+        return total - times[:, idle].sum(axis=1), total
+
+    busy, totals = array('d'), array('d')
+    for times in percpu:
+        total = sum(times) - sum(times[i] for i in guest)
+        totals.append(total)
+        busy.append(total - sum(times[i] for i in idle))
+    return busy, totals
+
+
+# The busy percentage of each core between two updates, from their cumulative busy and total
+# times: `total` is one per core, or one number for all of them (a container's cores share the
+# host's clock). The last times are kept in numpy arrays when numpy is installed, else in
+# array('d'), and all the cores are computed in one pass.
+class CoreUsage(object):
+    def __init__(self):
+        self.busy = None
+        self.total = None
+
+    def update(self, busy, total):
+        if numpy is not None:
+            busy = numpy.asarray(busy, dtype=float)
+            total = numpy.asarray(total, dtype=float)
+        else:
+            if not isinstance(busy, array):
+                busy = array('d', busy)
+            if isinstance(total, (list, tuple)):
+                total = array('d', total)
+        prev_busy, prev_total = self.busy, self.total
+        self.busy, self.total = busy, total
+        if prev_busy is None or len(prev_busy) != len(busy):
+            return None
+
+        if numpy is not None:
+            elapsed = total - prev_total
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                percents = numpy.where(elapsed > 0, 100.0 * (busy - prev_busy) / elapsed, 0.0)
+            # A core whose counter went backwards (a restarted container) counts as idle
+            return numpy.clip(percents, 0.0, 100.0)
+
+        if isinstance(total, array):
+            return array('d', [min(100.0, max(0.0, 100.0 * (b - pb) / (t - pt))) if t > pt else 0.0
+                               for b, pb, t, pt in zip(busy, prev_busy, total, prev_total)])
+        elapsed = total - prev_total
+        if elapsed <= 0:
+            return array('d', [0.0]) * len(busy)
+        scale = 100.0 / elapsed
+        return array('d', [min(100.0, max(0.0, (b - pb) * scale)) for b, pb in zip(busy, prev_busy)])
+
+
+# (name, value) of the max, min, mean and PERCENTILES of the cores' busy percentages, and of
+# the number of cores busier than `threshold` percent (saturated)
+def summarize(percents, threshold):
+    if numpy is not None and isinstance(percents, numpy.ndarray):
+        ordered = numpy.sort(percents)
+        mean = float(percents.mean())
+        saturated = int((percents > threshold).sum())
+    else:
+        ordered = sorted(percents)
+        mean = sum(percents) / len(percents)
+        saturated = sum(1 for percent in percents if percent > threshold)
+    summary = [('max', float(ordered[-1])), ('min', float(ordered[0])), ('mean', mean)]
+    for p in PERCENTILES:
+        rank = max(0, int(math.ceil(p / 100 * len(ordered))) - 1)
+        summary.append(('p{}'.format(p), float(ordered[rank])))
+    summary.append(('saturated', saturated))
+    return summary
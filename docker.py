@@ -1,33 +1,445 @@
+import calendar
 import socket
 import json
-from httplib import HTTPResponse
-from StringIO import StringIO
+import threading
+import time
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 from common import log
 
 
-class FakeSocket(object):
-    def __init__(self, response_str):
-        self._file = StringIO(response_str)
-    def makefile(self, *args, **kwargs):
-        return self._file
-
-
-def get(addr, path, debug=False):
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    client.connect(addr)
-    client.send("GET {} HTTP/1.0\r\n\r\n".format(path))
-    resp_str = client.recv(65536)
-    source = FakeSocket(resp_str)
-    resp = HTTPResponse(source)
-    resp.begin()
-    if resp.status == 200:
-        text = resp.read(len(resp_str))
-        data = json.loads(text)
+class DockerError(Exception):
+    pass
+
+
+# The daemon answered with an error status
+class DaemonError(DockerError):
+    def __init__(self, status, message):
+        DockerError.__init__(self, "HTTP {}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+# The connection was closed before the end of the response
+class TruncatedResponse(DockerError):
+    def __init__(self, received):
+        DockerError.__init__(self, "connection closed after {} bytes of the response".format(received))
+        self.received = received
+
+
+# Minimal HTTP/1.1 client connection to the daemon's Unix socket. Responses are received
+# into one reusable buffer and read up to their Content-Length or their last chunk.
+class Connection(object):
+    BUFSIZE = 65536
+
+    def __init__(self, addr, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(addr)
+        self.received = 0  # bytes received of the current response
+        self._buf = bytearray(self.BUFSIZE)
+        self._view = memoryview(self._buf)
+        self._pending = bytearray()
+        self._body = bytearray()
+
+    def _fill(self):
+        n = self.sock.recv_into(self._buf)
+        if not n:
+            raise TruncatedResponse(self.received)
+        self.received += n
+        self._pending += self._view[:n]
+
+    def _readline(self):
+        while True:
+            end = self._pending.find(b'\r\n')
+            if end >= 0:
+                line = bytes(self._pending[:end])
+                del self._pending[:end + 2]
+                return line
+            self._fill()
+
+    def _read(self, size):
+        while len(self._pending) < size:
+            self._fill()
+        self._body += self._pending[:size]
+        del self._pending[:size]
+
+    def request(self, path):
+        self.received = 0
+        self.sock.sendall('GET {} HTTP/1.1\r\nHost: docker\r\n\r\n'.format(path).encode('ascii'))
+
+        try:
+            version, status = self._readline().split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise DockerError("bad status line")
+
+        headers = {}
+        for line in iter(self._readline, b''):
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        del self._body[:]
+        if headers.get(b'transfer-encoding') == b'chunked':
+            while True:
+                size = int(self._readline().split(b';', 1)[0], 16)
+                if not size:
+                    break
+                self._read(size)
+                self._readline()
+            for trailer in iter(self._readline, b''):
+                pass
+        elif b'content-length' in headers:
+            self._read(int(headers[b'content-length']))
+        else:
+            raise DockerError("response without a length")
+
+        will_close = headers.get(b'connection') == b'close' or version == b'HTTP/1.0'
+        return status, self._body.decode('utf-8'), will_close
+
+    def close(self):
+        self.sock.close()
+
+
+# Keeps up to `size` idle HTTP/1.1 connections to the docker daemon open for reuse.
+class ConnectionPool(object):
+    def __init__(self, addr, size=8, timeout=None):
+        self.addr = addr
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return Connection(self.addr, self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, path):
+        conn, reused = self._acquire()
+        try:
+            status, body, will_close = conn.request(path)
+        except (socket.error, DockerError) as e:
+            conn.close()
+            if not reused or conn.received or isinstance(e, socket.timeout):
+                raise
+            # The daemon closed the idle connection before we used it, try once more on a fresh one
+            return self.request(path)
+
+        if will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return status, body
+
+    def get(self, path, debug=False):
+        status, body = self.request(path)
+        if status != 200:
+            try:
+                message = json.loads(body).get('message', body)
+            except (ValueError, AttributeError):
+                message = body
+            raise DaemonError(status, message.strip())
+
+        data = json.loads(body)
         if debug:
             log.debug(data)
         return data
 
-    return {}
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def compile_fields(fields):
+    plan = {}
+    for path, target in fields.items():
+        node = plan
+        keys = path.split('.')
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = target
+    return plan
+
+
+def _percpu(percpu, record):
+    record['num_cpus'] = len(percpu)
+    record['percpu'] = percpu
+
+
+# When the daemon took the sample, e.g. "2017-03-04T08:31:24.163012587Z", in seconds since the epoch.
+# Streams start with the zero time, "0001-01-01T00:00:00Z".
+def _read(value, record):
+    try:
+        seconds = calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+        fraction = value[19:].rstrip('Z')
+        record['read'] = seconds + (float(fraction) if fraction.startswith('.') else 0) if seconds > 0 else None
+    except ValueError:
+        record['read'] = None
+
+
+def _network(counters, record):
+    for counter in NETWORK_COUNTERS:
+        record[counter] += counters.get(counter) or 0
+
+
+def _networks(networks, record):
+    for counters in networks.values():
+        _network(counters, record)
+
+
+def _blkio(entries, record):
+    for entry in entries:
+        op = entry.get('op', '').lower()
+        if op == 'read':
+            record['read_bytes'] += entry.get('value') or 0
+        elif op == 'write':
+            record['write_bytes'] += entry.get('value') or 0
+
+
+NETWORK_COUNTERS = ['rx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped',
+                    'tx_bytes', 'tx_packets', 'tx_errors', 'tx_dropped']
+
+# The stats document fields run_docker uses, compiled into one tree so that every document
+# is walked once. A target is either the record key to copy the value to, or a function
+# that adds the value to the record.
+STATS_PLAN = compile_fields({
+    'read': _read,
+    'cpu_stats.cpu_usage.total_usage': 'cpu_total',
+    'cpu_stats.cpu_usage.percpu_usage': _percpu,
+    'cpu_stats.online_cpus': 'online_cpus',
+    'cpu_stats.system_cpu_usage': 'cpu_system',
+    'cpu_stats.throttling_data.periods': 'periods',
+    'cpu_stats.throttling_data.throttled_periods': 'throttled_periods',
+    'precpu_stats.cpu_usage.total_usage': 'precpu_total',
+    'precpu_stats.system_cpu_usage': 'precpu_system',
+    'memory_stats.usage': 'mem_usage',
+    'memory_stats.limit': 'mem_limit',
+    'memory_stats.stats.cache': 'mem_cache',
+    'memory_stats.stats.rss': 'mem_rss',
+    'memory_stats.stats.file': 'mem_cache',  # cgroup v2
+    'memory_stats.stats.anon': 'mem_rss',
+    'networks': _networks,
+    'network': _network,  # API < 1.21, a single interface
+    'blkio_stats.io_service_bytes_recursive': _blkio,
+})
+
+STATS_RECORD = dict([(key, 0) for key in ['cpu_total', 'cpu_system', 'periods', 'throttled_periods', 'precpu_total',
+                                          'precpu_system', 'mem_usage', 'mem_limit', 'mem_cache', 'mem_rss',
+                                          'read_bytes', 'write_bytes'] + NETWORK_COUNTERS])
+
+
+def extract(plan, document, record):
+    for key, target in plan.items():
+        value = document.get(key)
+        if value is None:
+            continue
+        if isinstance(target, dict):
+            if isinstance(value, dict):
+                extract(target, value, record)
+        elif callable(target):
+            target(value, record)
+        else:
+            record[target] = value
+    return record
+
+
+def stats_record(stats):
+    record = extract(STATS_PLAN, stats, dict(STATS_RECORD, read=None, percpu=None))
+    record['num_cpus'] = record.pop('online_cpus', 0) or record.get('num_cpus') or 1
+    return record
+
+
+def is_running(container):
+    # Older daemons only report the human readable status, e.g. "Up 5 hours"
+    return container.get('State', 'running') == 'running' and container.get('Status', '').startswith('Up')
+
+
+# Reads a never-ending response of newline-delimited JSON documents, reconnecting with
+# exponential backoff. The request is HTTP/1.0 so the daemon sends the body unchunked.
+class JSONStream(threading.Thread):
+    MAX_BACKOFF = 30
+
+    def __init__(self, addr, path, timeout=None, name=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.addr = addr
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._stopped = False
+        self._backoff = 1
+        self.errors = 0
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self._read()
+            except (socket.error, ValueError, IndexError) as e:
+                if not self._stopped:
+                    self.errors += 1
+                    log.error("{}: {}: {}".format(self.name, self.path, e))
+            self.disconnected()
+            if not self._stopped:
+                time.sleep(self._backoff)
+                self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+
+    def _read(self):
+        self._sock = sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.addr)
+            sock.sendall('GET {} HTTP/1.0\r\n\r\n'.format(self.path).encode('ascii'))
+            f = sock.makefile('rb')
+            status = f.readline().split(None, 2)[1]
+            while f.readline().strip():
+                pass
+            if status != b'200':
+                raise ValueError("HTTP {}".format(status.decode('ascii')))
+
+            self.connected()
+            for line in iter(f.readline, b''):
+                if line.strip():
+                    self.received(json.loads(line.decode('utf-8')))
+                    self._backoff = 1
+        finally:
+            sock.close()
+
+    def connected(self):
+        pass
+
+    def received(self, document):
+        raise NotImplementedError
+
+    def disconnected(self):
+        pass
+
+    def stop(self):
+        self._stopped = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
+
+# Keeps only the latest sample of /containers/{id}/stats?stream=1.
+class StatsStream(JSONStream):
+    def __init__(self, addr, id_, timeout=None):
+        JSONStream.__init__(self, addr, '/containers/{}/stats?stream=1'.format(id_), timeout, name=id_[:12])
+        self.id = id_
+        self.stats = None
+
+    def received(self, document):
+        self.stats = document
+
+    def disconnected(self):
+        self.stats = None
+
+
+class StatsStreams(object):
+    def __init__(self, addr, timeout=None):
+        self.addr = addr
+        self.timeout = timeout
+        self.streams = {}
+        self._errors = 0  # of the streams stopped since
+
+    def sync(self, ids):
+        for id_ in set(self.streams) - set(ids):
+            stream = self.streams.pop(id_)
+            stream.stop()
+            self._errors += stream.errors
+        for id_ in ids:
+            if id_ not in self.streams:
+                stream = self.streams[id_] = StatsStream(self.addr, id_, self.timeout)
+                stream.start()
+
+    def get(self, id_):
+        stream = self.streams.get(id_)
+        return stream.stats if stream is not None else None
+
+    @property
+    def errors(self):
+        return self._errors + sum(stream.errors for stream in self.streams.values())
+
+    def close(self):
+        self.sync([])
+
+
+# Running containers, listed once and then kept up to date from /events. The full list is
+# fetched again every `resync` seconds and whenever the events stream (re)connects, in case
+# events were missed.
+class ContainerIndex(JSONStream):
+    EVENTS = ['start', 'die', 'destroy', 'rename']
+
+    def __init__(self, pool, resync=300):
+        filters = json.dumps({'type': ['container'], 'event': self.EVENTS})
+        JSONStream.__init__(self, pool.addr, '/events?filters={}'.format(quote(filters)), name='events')
+        self.pool = pool
+        self.resync = resync
+        self._containers = {}
+        self._synced = 0
+        self._pending = None  # the events received while /containers/json is fetched
+        self._lock = threading.Lock()
+
+    def connected(self):
+        self._synced = 0
+
+    def received(self, event):
+        action = event.get('Action', event.get('status'))
+        actor = event.get('Actor', {})
+        id_ = actor.get('ID', event.get('id'))
+        name = actor.get('Attributes', {}).get('name')
+        with self._lock:
+            self._apply(action, id_, name)
+            if self._pending is not None:
+                self._pending.append((action, id_, name))
+
+    # Called with the lock held
+    def _apply(self, action, id_, name):
+        if action in ('die', 'destroy'):
+            self._containers.pop(id_, None)
+        elif name is None:
+            # Older daemons don't send the container name with the event
+            self._synced = 0
+        elif action == 'start':
+            self._containers[id_] = {'Id': id_, 'Names': ['/' + name], 'State': 'running', 'Status': 'Up'}
+        elif action == 'rename' and id_ in self._containers:
+            self._containers[id_]['Names'] = ['/' + name]
+
+    def containers(self, debug=False):
+        if time.time() - self._synced >= self.resync:
+            with self._lock:
+                self._pending = []
+            try:
+                running = self.pool.get('/containers/json', debug)
+            except (socket.error, DockerError, ValueError) as e:
+                self.errors += 1
+                log.error("/containers/json: {}".format(e))
+                with self._lock:
+                    self._pending = None
+            else:
+                with self._lock:
+                    self._containers = dict((container.get('Id'), container) for container in running)
+                    self._synced = time.time()
+                    # The list may predate the events that came while it was fetched: they go on top
+                    for action, id_, name in self._pending:
+                        self._apply(action, id_, name)
+                    self._pending = None
+
+        with self._lock:
+            return list(self._containers.values())
 
 
 """
@@ -0,0 +1,79 @@
+# How a metric's tags are put on the wire:
+#   influx     system.cpu.percent,host=web1:12.5|g
+#   dogstatsd  system.cpu.percent:12.5|g|#host:web1
+#   plain      system.cpu.percent.web1:12.5|g   (the tag values, as dotted name parts)
+FORMATS = ['influx', 'dogstatsd', 'plain']
+
+
+# One metric, with its prefix and tags, rendered for the wire once: a stat is then the head, the
+# value as statsd formats it ("12.5|g") and the tail. `gauge` is the "|g" and the tail together.
+class Metric(object):
+    __slots__ = ('name', 'tags', 'format', 'head', 'tail', 'gauge')
+
+    def __init__(self, name, tags=(), format='influx'):
+        self.name = name
+        self.tags = tuple(tags)
+        self.format = format
+        if format == 'dogstatsd':
+            self.head = name + ':'
+            self.tail = '|#' + ','.join('{}:{}'.format(key, value) for key, value in self.tags) if self.tags else ''
+        elif format == 'plain':
+            self.head = '.'.join([name] + [str(value).replace('.', '-') for _, value in self.tags]) + ':'
+            self.tail = ''
+        else:
+            self.head = name + ''.join(',{}={}'.format(key, value) for key, value in self.tags) + ':'
+            self.tail = ''
+        # Under python 2 these are already bytes, under python 3 the datagram is encoded once
+        self.head, self.tail = str(self.head), str(self.tail)
+        self.gauge = '|g' + self.tail
+
+    # The same metric with `suffix` added to its name, e.g. the .max of an aggregated gauge
+    def child(self, suffix):
+        return Metric('{}.{}'.format(self.name, suffix), self.tags, self.format)
+
+    def render(self, value):
+        return self.head + value + self.tail
+
+    def __eq__(self, other):
+        return isinstance(other, Metric) and self.head == other.head and self.tail == other.tail
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.head, self.tail))
+
+    def __repr__(self):
+        return 'Metric({!r})'.format(self.render('<value>'))
+
+
+# The metrics under a prefix, each rendered the first time it is looked up, with the common tags:
+#   metrics['percent']  or, with tags of its own put before those,  metrics['percent', ('nic', 'eth0')]
+class Metrics(dict):
+    MAX_CACHED = 10000  # metrics kept, for the tags that come and go (processes, containers)
+
+    def __init__(self, prefix='', tags=(), format='influx'):
+        super(Metrics, self).__init__()
+        self.prefix = prefix or ''
+        self.tags = tuple(tags)
+        self.format = format
+        self.children = {}
+
+    def __missing__(self, key):
+        if len(self) >= self.MAX_CACHED:
+            self.clear()
+        name, tags = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        metric = self[key] = Metric(self.join(name), tags + self.tags, self.format)
+        return metric
+
+    def join(self, name):
+        return '{}.{}'.format(self.prefix, name) if self.prefix and name else self.prefix or name
+
+    # The metrics under `prefix` (relative to this one), with `tags` before the common ones. Kept,
+    # like the metrics: for those of a container, that comes and goes, make a Metrics of its own.
+    def under(self, prefix='', tags=()):
+        key = (prefix, tuple(tags))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = Metrics(self.join(prefix), key[1] + self.tags, self.format)
+        return child
@@ -0,0 +1,114 @@
+from __future__ import division
+import heapq
+import re
+import time
+from contextlib import contextmanager
+from operator import itemgetter
+
+import psutil
+
+# Process names go into a field value: keep them clear of the statsd/influx separators
+UNSAFE = re.compile(r'[^\w.-]')
+
+
+@contextmanager
+def nothing():
+    yield
+
+
+# psutil < 5.0 has no oneshot(): read each value separately
+def oneshot(process):
+    return process.oneshot() if hasattr(process, 'oneshot') else nothing()
+
+
+# Whether the PID still belongs to the process `process` was made for. Process.create_time() only
+# returns the time cached when it was made: psutil's platform layer reads it again, on Linux from
+# the /proc/<pid>/stat oneshot() already holds for cpu_times(). Without it, is_running() does,
+# with a new Process.
+def same_process(process):
+    platform = getattr(process, '_proc', None)
+    if hasattr(platform, 'create_time'):
+        return platform.create_time() == process.create_time()
+    return process.is_running()
+
+
+class Tracked(object):
+    __slots__ = ('process', 'name', 'cpu', 'rss', 'percent', 'denied')
+
+    def __init__(self, process):
+        self.process = process
+        self.name = UNSAFE.sub('_', process.name()) or 'unknown'
+        self.cpu = None
+        self.rss = 0
+        self.percent = None
+        self.denied = False
+
+
+# Placeholder for the processes we may not read (other users' on Windows)
+class Denied(object):
+    name = None
+    percent = None
+    rss = None
+    denied = True
+
+
+DENIED = Denied()
+
+
+# Every process on the host, kept across updates so that each one only costs the reads of its
+# cpu times and memory (batched by oneshot()) per update. Exited processes are evicted and a
+# reused PID is detected by its creation time (see same_process).
+class ProcessTable(object):
+    def __init__(self):
+        self.tracked = {}
+        self.timer = None
+
+    def update(self):
+        timer = time.time()
+        elapsed = timer - self.timer if self.timer is not None else 0  # s
+        self.timer = timer
+
+        pids = psutil.pids()
+        alive = set(pids)
+        for pid in [pid for pid in self.tracked if pid not in alive]:
+            del self.tracked[pid]
+
+        for pid in pids:
+            entry = self.tracked.get(pid)
+            if entry is not None and entry.denied:
+                continue
+            try:
+                if entry is None:
+                    entry = self.tracked[pid] = Tracked(psutil.Process(pid))
+                process = entry.process
+                with oneshot(process):
+                    if not same_process(process):
+                        entry = self.tracked[pid] = Tracked(psutil.Process(pid))
+                        process = entry.process
+                    times = process.cpu_times()
+                    entry.rss = process.memory_info().rss
+
+                cpu = times.user + times.system
+                if entry.cpu is not None and elapsed > 0:
+                    # % of one CPU, like top
+                    entry.percent = max(0.0, 100.0 * (cpu - entry.cpu) / elapsed)
+                entry.cpu = cpu
+            except psutil.AccessDenied:
+                self.tracked[pid] = DENIED
+            except psutil.Error:  # exited in the meantime
+                self.tracked.pop(pid, None)
+
+    def _top(self, n, value):
+        totals = {}
+        for entry in self.tracked.values():
+            v = value(entry)
+            if v is not None:
+                # All the processes of a program count as one (nginx workers, ...)
+                totals[entry.name] = totals.get(entry.name, 0) + v
+        return heapq.nlargest(n, totals.items(), key=itemgetter(1))
+
+    def top_cpu(self, n):
+        return self._top(n, lambda entry: entry.percent)
+
+    def top_rss(self, n):
+        return self._top(n, lambda entry: entry.rss)
@@ -0,0 +1,193 @@
+from __future__ import division
+import io
+import os
+import threading
+from collections import namedtuple
+
+PROC = '/proc'
+SYS_BLOCK = '/sys/block'
+SECTOR_SIZE = 512
+BUFFER = 65536  # bytes read at once, more than these files take on most hosts
+FIRST_LINE = 4096  # more than the first line of /proc/stat
+
+CPU_FIELDS = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal', 'guest', 'guest_nice']
+
+svmem = namedtuple('svmem', ['total', 'available', 'percent', 'used', 'free', 'active', 'inactive', 'buffers',
+                             'cached', 'shared'])
+sswap = namedtuple('sswap', ['total', 'used', 'free', 'percent'])
+snetio = namedtuple('snetio', ['bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv', 'errin', 'errout',
+                               'dropin', 'dropout'])
+sdiskio = namedtuple('sdiskio', ['read_count', 'write_count', 'read_bytes', 'write_bytes', 'read_time',
+                                 'write_time', 'busy_time'])
+
+# What is kept of /proc/meminfo, as found at the start of its line
+MEMINFO = {
+    'total': '\nMemTotal:',
+    'free': '\nMemFree:',
+    'available': '\nMemAvailable:',
+    'buffers': '\nBuffers:',
+    'cached': '\nCached:',
+    'reclaimable': '\nSReclaimable:',
+    'shared': '\nShmem:',
+    'active': '\nActive:',
+    'inactive': '\nInactive:',
+    'swap_total': '\nSwapTotal:',
+    'swap_free': '\nSwapFree:',
+}
+
+
+# The files are unbuffered: every read is a read(2) of the file as it is now. One of a known
+# size is much cheaper than reading to the end.
+def read(f, size=BUFFER):
+    f.seek(0)
+    data = f.read(size)
+    if len(data) == size:
+        data += f.read()
+    return data if isinstance(data, str) else data.decode('ascii')
+
+
+def first_line(f):
+    f.seek(0)
+    data = f.read(FIRST_LINE)
+    return (data if isinstance(data, str) else data.decode('ascii')).split('\n', 1)[0]
+
+
+# The value in kB on the line of `key`, in bytes
+def kilobytes(data, key):
+    start = data.find(key)
+    if start < 0:
+        return 0
+    start += len(key)
+    return int(data[start:data.index('k', start)]) * 1024
+
+
+def percent(used, total):
+    return round(100.0 * used / total, 1) if total else 0.0
+
+
+# The psutil calls of the Linux host collectors, answered from /proc files opened once and
+# re-read with seek(0), parsing only what the collectors send. Values follow psutil 5's
+# definitions; what this doesn't cover is left to psutil. The collectors run on threads of their
+# own: each file has a lock, so that a seek(0) and the reads after it are not interleaved.
+class ProcFS(object):
+    def __init__(self, proc=PROC, sys_block=SYS_BLOCK):
+        self.proc = proc
+        self.sys_block = sys_block
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._files = []
+        self._locks = {}  # file -> its lock
+        self._stat = self._open('stat')
+        self._meminfo = self._open('meminfo')
+        self._net = self._open('net/dev')
+        self._disks = self._open('diskstats')
+        self._storage = {}  # disk name -> whether it is a whole device rather than a partition
+
+        # The fields the kernel has, and when it booted: fixed until the next boot
+        cpu = self._first_line(self._stat).split()
+        self.scputimes = namedtuple('scputimes', CPU_FIELDS[:len(cpu) - 1])
+        self._boot_time = None
+        for line in self._read(self._stat).splitlines():
+            if line.startswith('btime'):
+                self._boot_time = float(line.split()[1])
+
+    def _open(self, name):
+        f = io.open(os.path.join(self.proc, name), 'rb', buffering=0)
+        self._files.append(f)
+        self._locks[f] = threading.Lock()
+        return f
+
+    def _read(self, f):
+        with self._locks[f]:
+            return read(f)
+
+    def _first_line(self, f):
+        with self._locks[f]:
+            return first_line(f)
+
+    def cpu_times(self, percpu=False):
+        width = len(self.scputimes._fields) + 1
+        if percpu:
+            # The cpuN lines follow the total; then come the interrupts, left unparsed
+            data = self._read(self._stat)
+            cpus = []
+            start = data.index('\ncpu') + 1
+            while data.startswith('cpu', start):
+                end = data.index('\n', start)
+                values = data[start:end].split()[1:width]
+                cpus.append(self.scputimes(*[int(value) / self.clock_ticks for value in values]))
+                start = end + 1
+            return cpus
+        # Only the first line: the per-CPU and interrupt lines can make up kilobytes on large hosts
+        values = self._first_line(self._stat).split()[1:width]
+        return self.scputimes(*[int(value) / self.clock_ticks for value in values])
+
+    def _memory(self):
+        data = '\n' + self._read(self._meminfo)
+        return dict((name, kilobytes(data, key)) for name, key in MEMINFO.items())
+
+    def virtual_memory(self):
+        memory = self._memory()
+        total, free, buffers = memory['total'], memory['free'], memory['buffers']
+        cached = memory['cached'] + memory['reclaimable']
+        used = total - free - cached - buffers
+        if used < 0:
+            used = total - free
+        available = memory['available']
+        if available > total:  # in some containers
+            available = free
+        return svmem(total, available, percent(total - available, total), used, free, memory['active'],
+                     memory['inactive'], buffers, cached, memory['shared'])
+
+    def swap_memory(self):
+        memory = self._memory()
+        total, free = memory['swap_total'], memory['swap_free']
+        return sswap(total, total - free, free, percent(total - free, total))
+
+    def net_io_counters(self, pernic=False):
+        nics = {}
+        for line in self._read(self._net).splitlines()[2:]:
+            name, _, counters = line.rpartition(':')
+            fields = counters.split()
+            nics[name.strip()] = snetio(int(fields[8]), int(fields[0]), int(fields[9]), int(fields[1]),
+                                        int(fields[2]), int(fields[10]), int(fields[3]), int(fields[11]))
+        if pernic:
+            return nics
+        return snetio(*[sum(values) for values in zip(*nics.values())])
+
+    def is_storage(self, name):
+        storage = self._storage.get(name)
+        if storage is None:
+            storage = self._storage[name] = os.path.exists(os.path.join(self.sys_block, name.replace('/', '!')))
+        return storage
+
+    # The sum over whole devices, partitions left out, like psutil.disk_io_counters(perdisk=False)
+    def disk_io_counters(self, perdisk=False):
+        totals = [0] * len(sdiskio._fields)
+        for line in self._read(self._disks).splitlines():
+            fields = line.split()
+            if len(fields) == 14 or len(fields) >= 18:
+                name, counters = fields[2], fields[3:14]
+            elif len(fields) == 15:  # 2.6.25 and older
+                name, counters = fields[3], [fields[2]] + fields[4:14]
+            else:
+                continue
+            if not self.is_storage(name):
+                continue
+            # reads, merged, sectors read, read time, writes, merged, sectors written, write time, in flight, busy
+            for i, index in enumerate([0, 4, 2, 6, 3, 7, 9]):
+                totals[i] += int(counters[index])
+        totals[2] *= SECTOR_SIZE
+        totals[3] *= SECTOR_SIZE
+        return sdiskio(*totals)
+
+    def boot_time(self):
+        return self._boot_time
+
+    # Only their number is used: the names, left unparsed and unsorted
+    def pids(self):
+        return [name for name in os.listdir(self.proc) if name.isdigit()]
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
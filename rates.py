@@ -0,0 +1,88 @@
+from __future__ import division
+import time
+from array import array
+
+WRAP = 2 ** 32  # of 32 bit counters, for update(wrap=...): psutil >= 5.3 already un-wraps its own
+
+
+# Per second rates of counters, keyed by whatever identifies the thing counted (a NIC, a
+# container, ...). All the counters of one key are updated together and their previous values
+# kept side by side in one flat array; the first update of a key only records the values.
+class Rates(object):
+    def __init__(self):
+        self.slots = {}  # key -> (row, offset, width)
+        self.values = array('d')
+        self.times = array('d')
+        self.free = {}  # width -> [(row, offset)] left by discarded keys
+
+    def _slot(self, key, width):
+        slot = self.slots.get(key)
+        if slot is not None and slot[2] == width:
+            return slot, False
+
+        if slot is not None:
+            self.discard(key)
+        free = self.free.get(width)
+        if free:
+            row, offset = free.pop()
+        else:
+            row, offset = len(self.times), len(self.values)
+            self.times.append(0.0)
+            self.values.extend([0.0] * width)
+        slot = self.slots[key] = (row, offset, width)
+        return slot, True
+
+    # Returns one rate per counter, None for a counter that went backwards without wrapping
+    # (reset), or None instead of the list on the first update of `key`. With `restart`, a reset
+    # counter means the whole thing restarted (a container) and the update counts as the first.
+    # With `wrap`, the counters are that wide: one that drops from its top quarter has wrapped,
+    # unless with `restart`, where any drop is a restart.
+    def update(self, key, counters, now=None, restart=False, wrap=None):
+        if now is None:
+            now = time.time()
+        (row, offset, width), new = self._slot(key, len(counters))
+        elapsed = now - self.times[row]
+        self.times[row] = now
+
+        values = self.values
+        rates = None if new or elapsed <= 0 else []
+        for i, value in enumerate(counters):
+            prev, values[offset + i] = values[offset + i], value
+            if rates is None:
+                continue
+            delta = value - prev
+            if delta < 0:
+                if wrap and not restart and wrap * 3 // 4 <= prev < wrap:
+                    delta += wrap
+                else:
+                    rates.append(None)
+                    continue
+            rates.append(delta / elapsed)
+        if restart and rates is not None and None in rates:
+            return None
+        return rates
+
+    def rate(self, key, value, now=None, wrap=None):
+        rates = self.update(key, (value,), now, wrap=wrap)
+        return rates[0] if rates else None
+
+    def discard(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            row, offset, width = slot
+            self.free.setdefault(width, []).append((row, offset))
+
+    # Discards the keys last updated before `before`, their previous values are too old to
+    # compute a rate from. Returns them.
+    def expire(self, before):
+        times = self.times
+        expired = [key for key, (row, _, _) in self.slots.items() if times[row] < before]
+        for key in expired:
+            self.discard(key)
+        return expired
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __len__(self):
+        return len(self.slots)
@@ -0,0 +1,226 @@
+from __future__ import division
+import os
+import threading
+import time
+
+from common import log
+
+try:
+    import resource
+    # Linux only, and not exposed by python 2
+    RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+    resource.getrusage(RUSAGE_THREAD)
+except (ImportError, ValueError, OSError):
+    resource = None
+
+
+# CPU time of the calling thread (s), or None where it can't be had
+def thread_cpu_time():
+    if resource is None:
+        return None
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Job(object):
+    def __init__(self, name, func, interval, timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.base_interval = interval  # as configured; the Governor may stretch `interval`
+        self.timeout = timeout or interval
+        self.deadline = 0
+        self.missed = 0
+        self.timeouts = 0
+        self.started = None  # start time of the current run, None when idle
+        self.elapsed = 0
+        self.cpu = None
+        self.reported = 0  # missed ticks already reported
+        self.timed_out = False
+        self.batch = None
+        self._wake = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self, batch, now):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        self.batch = batch
+        self.started = now
+        self.timed_out = False
+        self._done.clear()
+        self._wake.set()
+
+    def wait(self, until):
+        return self._done.wait(max(0, min(until, self.started + self.timeout) - time.time()))
+
+    def finished(self):
+        return self._done.is_set()
+
+    def advance(self, now):
+        self.deadline += self.interval
+        if self.deadline <= now:
+            # Skip the ticks we are already late for instead of running them back to back
+            skipped = int((now - self.deadline) // self.interval) + 1
+            self.deadline += skipped * self.interval
+            self.missed += skipped
+            log.debug("{}: skipped {} tick(s)".format(self.name, skipped))
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            cpu = thread_cpu_time()
+            try:
+                self.func(self.batch)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                self.elapsed = time.time() - self.started
+                self.cpu = thread_cpu_time() - cpu if cpu is not None else None
+                self._done.set()
+
+
+# Keeps the agent's CPU use (the user and system time of its process, all threads) under
+# `budget`, a fraction of one core, checked every `window` seconds. Over budget, the interval of
+# one job is doubled, up to `max_factor` times its configured one: the first of `order` that can
+# still be stretched, else the one with the most CPU time per second. Under half the budget, the
+# last job stretched is halved back, until all are at their configured intervals again.
+class Governor(object):
+    def __init__(self, budget, window=60, order=('docker', 'disk'), max_factor=8):
+        self.budget = budget
+        self.window = window
+        self.order = order
+        self.max_factor = max_factor
+        self.stretched = []  # the jobs above their configured interval, the latest last
+        self.checked = None  # wall and CPU time of the last check
+        self.usage = None
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return times[0] + times[1]
+
+    def costliest(self, jobs):
+        jobs = [job for job in jobs if job.interval < job.base_interval * self.max_factor]
+        for name in self.order:
+            for job in jobs:
+                if job.name == name:
+                    return job
+        jobs = [job for job in jobs if job.cpu]
+        return max(jobs, key=lambda job: job.cpu / job.interval) if jobs else None
+
+    # Called by the scheduler every tick; adjusts at most one job per window
+    def __call__(self, batch, jobs, now, metrics=None):
+        if self.checked is not None and now - self.checked[0] < self.window:
+            return
+        cpu = self.cpu_time()
+        if self.checked is None:
+            self.checked = now, cpu
+            return
+        self.usage = (cpu - self.checked[1]) / (now - self.checked[0])
+        self.checked = now, cpu
+
+        job, action = None, None
+        if self.usage > self.budget:
+            job, action = self.costliest(jobs), 'stretched'
+            if job is not None:
+                job.interval = min(job.interval * 2, job.base_interval * self.max_factor)
+                if job not in self.stretched:
+                    self.stretched.append(job)
+        elif self.usage < self.budget / 2 and self.stretched:
+            job, action = self.stretched[-1], 'restored'
+            job.interval = max(job.base_interval, job.interval / 2)
+            if job.interval == job.base_interval:
+                self.stretched.pop()
+        if job is not None:
+            log.info("governor: CPU {:.2%} of a core (budget {:.2%}), {} {} to {}s".format(
+                self.usage, self.budget, action, job.name, job.interval))
+
+        if metrics is not None:
+            batch.gauge(metrics['governor.cpu.percent'], self.usage * 100)
+            if job is not None:
+                batch.incr(metrics['governor.' + action, ('collector', job.name)])
+            # The stretched jobs, and the one just restored to its configured interval
+            for adjusted in self.stretched + ([job] if job is not None and job not in self.stretched else []):
+                batch.gauge(metrics['governor.interval', ('collector', adjusted.name)], adjusted.interval)
+
+
+# Runs each job on its own worker thread at absolute deadlines (start + n * interval), so
+# timing does not drift and a hung job only delays itself. The results of all the jobs that
+# finish in the same tick are flushed together through one batch. With `metrics` (the agent's
+# metrics.Metrics), the wall and CPU time of each run, skipped ticks and timeouts are sent as
+# collector.* stats. With a `governor`, the intervals give way to the agent's CPU budget.
+class Scheduler(object):
+    def __init__(self, transport, metrics=None, governor=None):
+        self.transport = transport
+        self.metrics = metrics
+        self.governor = governor
+        self.jobs = []
+
+    def add(self, name, func, interval, timeout=None):
+        job = Job(name, func, interval, timeout)
+        self.jobs.append(job)
+        return job
+
+    def next_deadline(self):
+        return min(job.deadline for job in self.jobs)
+
+    def run_pending(self, now):
+        for job in self.jobs:
+            if job.deadline > now:
+                continue
+            if job.started is not None:
+                job.missed += 1
+                log.debug("{}: still running, skipped tick".format(job.name))
+            else:
+                job.start(self.transport.pipeline(), now)
+            job.advance(now)
+
+    def collect(self, until):
+        running = [job for job in self.jobs if job.started is not None]
+        for job in running:
+            job.wait(until)
+
+        now = time.time()
+        with self.transport.pipeline() as batch:
+            for job in running:
+                done = job.finished()
+                if done and job.elapsed <= job.timeout:
+                    batch.extend(job.batch)
+                    if self.metrics is not None:
+                        self.report(batch, job)
+                elif not job.timed_out and now - job.started > job.timeout:
+                    # Whatever it eventually collects is dropped
+                    job.timed_out = True
+                    job.timeouts += 1
+                    log.error("{}: timed out after {}s".format(job.name, job.timeout))
+                    if self.metrics is not None:
+                        batch.incr(self.metrics['collector.timeouts', ('collector', job.name)])
+                if done:
+                    job.started, job.batch = None, None
+            if self.governor is not None:
+                self.governor(batch, self.jobs, now, self.metrics)
+
+    def report(self, batch, job):
+        tag = ('collector', job.name)
+        batch.timing(self.metrics['collector.time', tag], job.elapsed * 1000)
+        if job.cpu is not None:
+            batch.timing(self.metrics['collector.cpu_time', tag], job.cpu * 1000)
+        if job.missed > job.reported:
+            batch.incr(self.metrics['collector.overruns', tag], job.missed - job.reported)
+            job.reported = job.missed
+
+    # `wait(seconds)` sleeps until the next tick and returns True to stop the scheduler.
+    def run(self, wait=time.sleep):
+        start = time.time()
+        for job in self.jobs:
+            job.deadline = start
+
+        while True:
+            self.run_pending(time.time())
+            self.collect(self.next_deadline())
+            if wait(max(0, self.next_deadline() - time.time())):
+                return
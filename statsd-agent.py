@@ -6,7 +6,7 @@ import socket
 import os
 import sys
 import traceback
-import jmespath
+from functools import partial
 from common import log
 
 try:
@@ -14,10 +14,11 @@ try:
 except ImportError:
     from configparser import RawConfigParser, Error
 
-from docker import get
+from metrics import FORMATS, Metrics
+from rates import Rates
+from transport import ROUTING, TRANSPORTS, Suppressor, make_transport, parse_destination
 
 import psutil
-import statsd
 
 
 
@@ -25,6 +26,13 @@ system = platform.system()
 isLinux = system == 'Linux'
 isWindows = system == 'Windows'
 
+# What the host collectors read from: psutil, or with --backend proc, a procfs.ProcFS
+sysinfo = psutil
+
+# Busy percentage over which cpu_cores counts a core as saturated, and whether it sends every core
+core_threshold = 90
+core_gauges = False
+
 
 def to_int(value, default):
     try:
@@ -33,233 +41,579 @@ def to_int(value, default):
         return default
 
 
-def disk(host, port, prefix, fields, debug=False):
-    prefix = '.'.join([prefix, 'disk']) if prefix else 'disk'
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    disk_usage = psutil.disk_usage('/')
-    with client.pipeline() as pipe:
-        pipe.gauge('root.total{}'.format(fields), disk_usage.total)
-        pipe.gauge('root.used{}'.format(fields), disk_usage.used)
-        pipe.gauge('root.free{}'.format(fields), disk_usage.free)
-        pipe.gauge('root.percent{}'.format(fields), disk_usage.percent)
-
-        counters = psutil.disk_io_counters(False)
-        pipe.gauge('all.read_time{}'.format(fields), counters.read_time)
-        pipe.gauge('all.write_time{}'.format(fields), counters.write_time)
-        if isLinux:
-            pipe.gauge('all.busy_time{}'.format(fields), counters.busy_time)
+def to_float(value, default):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return default
 
 
-def cpu_times(host, port, prefix, fields, debug=False):
-    prefix = '.'.join([prefix, 'cpu']) if prefix else 'cpu'
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    cpu_times = psutil.cpu_times()
-    with client.pipeline() as pipe:
-        pipe.gauge('times.user{}'.format(fields), cpu_times.user)
-        pipe.gauge('times.system{}'.format(fields), cpu_times.system)
-        pipe.gauge('times.idle{}'.format(fields), cpu_times.idle)
+disk_rates = Rates()
 
-        if not isWindows:
-            pipe.gauge('times.nice{}'.format(fields), cpu_times.nice)
-            load = os.getloadavg()
-            pipe.gauge('loadavg.1{}'.format(fields), load[0])
-            pipe.gauge('loadavg.5{}'.format(fields), load[1])
-            pipe.gauge('loadavg.15{}'.format(fields), load[2])
 
+def disk(batch, metrics, debug=False):
+    disk_usage = psutil.disk_usage('/')
+    with batch.pipeline() as pipe:
+        pipe.gauge(metrics['root.total'], disk_usage.total)
+        pipe.gauge(metrics['root.used'], disk_usage.used)
+        pipe.gauge(metrics['root.free'], disk_usage.free)
+        pipe.gauge(metrics['root.percent'], disk_usage.percent)
+
+        counters = sysinfo.disk_io_counters(False)
+        rates = disk_rates.update('all', [counters.read_bytes, counters.write_bytes,
+                                          counters.read_count, counters.write_count])
+        if rates is not None:
+            for metric, rate in zip(['all.read_rate', 'all.write_rate', 'all.read_ops', 'all.write_ops'], rates):
+                if rate is not None:
+                    pipe.gauge(metrics[metric], rate)
+
+        pipe.gauge(metrics['all.read_time'], counters.read_time)
+        pipe.gauge(metrics['all.write_time'], counters.write_time)
         if isLinux:
-            pipe.gauge('times.guest_nice{}'.format(fields), cpu_times.guest_nice)
-            pipe.gauge('times.guest{}'.format(fields), cpu_times.guest)
-            pipe.gauge('times.steal{}'.format(fields), cpu_times.steal)
-            pipe.gauge('times.softirq{}'.format(fields), cpu_times.softirq)
-            pipe.gauge('times.iowait{}'.format(fields), cpu_times.iowait)
-            pipe.gauge('times.irq{}'.format(fields), cpu_times.irq)
-
-
-def cpu_times_percent(host, port, prefix, fields, debug=False):
-    prefix = '.'.join([prefix, 'cpu']) if prefix else 'cpu'
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    value = psutil.cpu_percent(interval=1)
-    cpu_times_pcnt = psutil.cpu_times_percent(interval=1)
-
-    with client.pipeline() as pipe:
-        pipe.gauge('percent{}'.format(fields), value)
-        pipe.gauge('percent.user{}'.format(fields), cpu_times_pcnt.user)
-        pipe.gauge('percent.system{}'.format(fields), cpu_times_pcnt.system)
-        pipe.gauge('percent.idle{}'.format(fields), cpu_times_pcnt.idle)
+            pipe.gauge(metrics['all.busy_time'], counters.busy_time)
 
-        if not isWindows:
-            pipe.gauge('percent.nice{}'.format(fields), cpu_times_pcnt.nice)
 
-        if isLinux:
-            pipe.gauge('percent.iowait{}'.format(fields), cpu_times_pcnt.iowait)
-            pipe.gauge('percent.irq{}'.format(fields), cpu_times_pcnt.irq)
-            pipe.gauge('percent.softirq{}'.format(fields), cpu_times_pcnt.softirq)
-            pipe.gauge('percent.steal{}'.format(fields), cpu_times_pcnt.steal)
-            pipe.gauge('percent.guest{}'.format(fields), cpu_times_pcnt.guest)
-            pipe.gauge('percent.guest_nice{}'.format(fields), cpu_times_pcnt.guest_nice)
-
-
-def memory(host, port, prefix, fields, debug=False):
-    prefix = '.'.join([prefix, 'memory']) if prefix else 'memory'
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    with client.pipeline() as pipe:
-        virtual = psutil.virtual_memory()
-        pipe.gauge('virtual.total{}'.format(fields), virtual.total)
-        pipe.gauge('virtual.available{}'.format(fields), virtual.available)
-        pipe.gauge('virtual.used{}'.format(fields), virtual.used)
-        pipe.gauge('virtual.free{}'.format(fields), virtual.free)
-        pipe.gauge('virtual.percent{}'.format(fields), virtual.percent)
-
-        swap = psutil.swap_memory()
-        pipe.gauge('swap.total{}'.format(fields), swap.total)
-        pipe.gauge('swap.used{}'.format(fields), swap.used)
-        pipe.gauge('swap.free{}'.format(fields), swap.free)
-        pipe.gauge('swap.percent{}'.format(fields), swap.percent)
+def cpu_times(batch, metrics, debug=False):
+    cpu_times = sysinfo.cpu_times()
+    with batch.pipeline() as pipe:
+        pipe.gauge(metrics['times.user'], cpu_times.user)
+        pipe.gauge(metrics['times.system'], cpu_times.system)
+        pipe.gauge(metrics['times.idle'], cpu_times.idle)
 
         if not isWindows:
-            pipe.gauge('virtual.active{}'.format(fields), virtual.active)
-            pipe.gauge('virtual.inactive{}'.format(fields), virtual.inactive)
+            pipe.gauge(metrics['times.nice'], cpu_times.nice)
+            load = os.getloadavg()
+            pipe.gauge(metrics['loadavg.1'], load[0])
+            pipe.gauge(metrics['loadavg.5'], load[1])
+            pipe.gauge(metrics['loadavg.15'], load[2])
 
         if isLinux:
-            pipe.gauge('virtual.buffers{}'.format(fields), virtual.buffers)
-            pipe.gauge('virtual.cached{}'.format(fields), virtual.cached)
+            pipe.gauge(metrics['times.guest_nice'], cpu_times.guest_nice)
+            pipe.gauge(metrics['times.guest'], cpu_times.guest)
+            pipe.gauge(metrics['times.steal'], cpu_times.steal)
+            pipe.gauge(metrics['times.softirq'], cpu_times.softirq)
+            pipe.gauge(metrics['times.iowait'], cpu_times.iowait)
+            pipe.gauge(metrics['times.irq'], cpu_times.irq)
 
 
-prev_bytes_sent, prev_bytes_recv, prev_timer = 0, 0, 0
+prev_cpu_times = None
 
 
-def network(host, port, prefix, fields, nic, debug=False):
-    global prev_bytes_sent, prev_bytes_recv, prev_timer
+def cpu_times_percent(batch, metrics, debug=False):
+    global prev_cpu_times
 
-    try:
-        net = psutil.net_io_counters(True)[nic]
-    except KeyError:
+    times = sysinfo.cpu_times()
+    prev, prev_cpu_times = prev_cpu_times, times
+    if prev is None:  # percentages are computed between two consecutive calls
         return
-    timer = time.time()
-    prefix = '.'.join([prefix, 'network']) if prefix else 'network'
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    sent = net.bytes_sent - prev_bytes_sent  # B
-    recv = net.bytes_recv - prev_bytes_recv
-    prev_bytes_sent = net.bytes_sent
-    prev_bytes_recv = net.bytes_recv
-    elapsed = timer - prev_timer  # s
-    send_rate = sent / elapsed  # B/s
-    recv_rate = recv / elapsed
-    prev_timer = timer
-
-    with client.pipeline() as pipe:
-        pipe.gauge('send_rate{}'.format(fields), send_rate)
-        pipe.gauge('recv_rate{}'.format(fields), recv_rate)
-        pipe.gauge('send_errors{}'.format(fields), net.errin)
-        pipe.gauge('recv_errors{}'.format(fields), net.errout)
-
-
-def misc(host, port, prefix, fields, debug=False):
-    boot_time = psutil.boot_time()
-    uptime = time.time() - boot_time
-    client = statsd.StatsClient(host, port, prefix=prefix)
-    with client.pipeline() as pipe:
-        pipe.gauge('uptime{}'.format(fields), uptime)
-        if debug:
-            log.debug("uptime={}".format(uptime))
-
-        pipe.gauge('users{}'.format(fields), len(psutil.users()))
-        pipe.gauge('processes{}'.format(fields), len(psutil.pids()))
-
-
-def run_once(host, port, prefix, fields, nic, debug=False):
-    misc(host, port, prefix, fields, debug)
-    network(host, port, prefix, fields, nic, debug)
-    memory(host, port, prefix, fields, debug)
-    cpu_times(host, port, prefix, fields, debug)
-    cpu_times_percent(host, port, prefix, fields, debug)
-    disk(host, port, prefix, fields, debug)
-
-
-def run_docker(address, interval, host, port, debug=False):
-    prev_cpu, prev_system = {}, {}
-    prev_tx_bytes, prev_rx_bytes, prev_timer = {}, {}, {}
-    client = statsd.StatsClient(host, port)
-    MEM_USAGE = jmespath.compile('memory_stats.usage')
-    MEM_LIMIT = jmespath.compile('memory_stats.limit')
-    TOTAL_USAGE = jmespath.compile('cpu_stats.cpu_usage.total_usage')
-    SYSTEM_USAGE = jmespath.compile('cpu_stats.system_cpu_usage')
-    NUM_CPUS = jmespath.compile('length(cpu_stats.cpu_usage.percpu_usage)')
-    TX_BYTES = jmespath.compile('networks.eth0.tx_bytes')  # TODO: Always eth0??? (likely not...)
-    RX_BYTES = jmespath.compile('networks.eth0.rx_bytes')
-    try:
-        while True:
-            with client.pipeline() as pipe:
-                start = time.time()
-                containers = get(address, '/containers/json?all=1', debug)
-                for container in containers:
-                    name = container.get('Names')[0].strip('/')
-                    status = container.get('Status')
-                    id_ = container.get('Id')
-                    log.debug("{}: {}".format(name, status))
-                    stats = get(address, '/containers/{}/stats?stream=0'.format(id_), debug)  # Very slow call...
 
-                    mem_usage = MEM_USAGE.search(stats) or 0
-                    mem_limit = MEM_LIMIT.search(stats) or 1
-                    mem_percent = 100.0 * (mem_usage / mem_limit) if mem_limit > 0 else 0
-
-                    if debug:
-                        log.debug("{}: Mem: {:,} {:,} {}%".format(name, mem_usage, mem_limit, mem_percent))
+    deltas = dict((name, max(0, cur - old)) for name, cur, old in zip(times._fields, times, prev))
+    total = sum(deltas.values())
+    if isLinux:
+        # guest time is already accounted for in user/nice time
+        total -= deltas['guest'] + deltas.get('guest_nice', 0)
+    if total <= 0:
+        return
+    cpu_times_pcnt = dict((name, min(100.0, 100.0 * delta / total)) for name, delta in deltas.items())
+    value = max(0.0, 100.0 - cpu_times_pcnt['idle'] - cpu_times_pcnt.get('iowait', 0))
 
-                    pipe.gauge('system.memory.virtual.percent,service={}'.format(name), mem_percent)
+    with batch.pipeline() as pipe:
+        pipe.gauge(metrics['percent'], value)
+        pipe.gauge(metrics['percent.user'], cpu_times_pcnt['user'])
+        pipe.gauge(metrics['percent.system'], cpu_times_pcnt['system'])
+        pipe.gauge(metrics['percent.idle'], cpu_times_pcnt['idle'])
 
-                    # http://stackoverflow.com/questions/30271942/get-docker-container-cpu-usage-as-percentage
-                    cpu_percent = 0
+        if not isWindows:
+            pipe.gauge(metrics['percent.nice'], cpu_times_pcnt['nice'])
 
-                    total_usage = TOTAL_USAGE.search(stats) or 0
-                    cpu_delta = total_usage - prev_cpu.get(name, 0)
+        if isLinux:
+            pipe.gauge(metrics['percent.iowait'], cpu_times_pcnt['iowait'])
+            pipe.gauge(metrics['percent.irq'], cpu_times_pcnt['irq'])
+            pipe.gauge(metrics['percent.softirq'], cpu_times_pcnt['softirq'])
+            pipe.gauge(metrics['percent.steal'], cpu_times_pcnt['steal'])
+            pipe.gauge(metrics['percent.guest'], cpu_times_pcnt['guest'])
+            pipe.gauge(metrics['percent.guest_nice'], cpu_times_pcnt['guest_nice'])
 
-                    system_usage = SYSTEM_USAGE.search(stats) or 0
-                    system_delta = system_usage - prev_system.get(name, 0)
 
-                    num_cpus = NUM_CPUS.search(stats) or 1
+core_usage = None
 
-                    if system_delta > 0 and cpu_delta > 0:
-                        cpu_percent = (cpu_delta / system_delta) * num_cpus * 100.0
 
-                    if debug:
-                        log.debug("{}: Cpu: {}, {}: {}%".format(name, cpu_delta, system_delta, cpu_percent))
+# The busy percentage of every core summarized, so that a saturated core shows on large hosts
+# without a gauge per core: cpu.cores.max, .min, .mean, .p90 and .saturated (the number of cores
+# busier than `threshold`). With `gauges`, each core's cpu.core.percent,core=N too.
+def cpu_cores(batch, metrics, threshold=90, gauges=False, debug=False):
+    global core_usage
+    from cores import CoreUsage, core_times, summarize
 
-                    prev_cpu[name], prev_system[name] = total_usage, system_usage
+    if core_usage is None:
+        core_usage = CoreUsage()
+    percpu = sysinfo.cpu_times(True)
+    if not percpu:
+        return
+    percents = core_usage.update(*core_times(percpu))
+    if percents is None:  # the first call, or the number of cores changed
+        return
 
-                    pipe.gauge('system.cpu.percent,service={}'.format(name), cpu_percent)
+    with batch.pipeline() as pipe:
+        for name, value in summarize(percents, threshold):
+            pipe.gauge(metrics['cores.' + name], value)
+        if gauges:
+            for i, percent in enumerate(percents):
+                pipe.gauge(metrics['core.percent', ('core', i)], float(percent))
+
+
+def memory(batch, metrics, debug=False):
+    with batch.pipeline() as pipe:
+        virtual = sysinfo.virtual_memory()
+        pipe.gauge(metrics['virtual.total'], virtual.total)
+        pipe.gauge(metrics['virtual.available'], virtual.available)
+        pipe.gauge(metrics['virtual.used'], virtual.used)
+        pipe.gauge(metrics['virtual.free'], virtual.free)
+        pipe.gauge(metrics['virtual.percent'], virtual.percent)
+
+        swap = sysinfo.swap_memory()
+        pipe.gauge(metrics['swap.total'], swap.total)
+        pipe.gauge(metrics['swap.used'], swap.used)
+        pipe.gauge(metrics['swap.free'], swap.free)
+        pipe.gauge(metrics['swap.percent'], swap.percent)
 
-                    tx_bytes = TX_BYTES.search(stats) or 0
-                    rx_bytes = RX_BYTES.search(stats) or 0
+        if not isWindows:
+            pipe.gauge(metrics['virtual.active'], virtual.active)
+            pipe.gauge(metrics['virtual.inactive'], virtual.inactive)
 
-                    tx = tx_bytes - prev_tx_bytes.setdefault(name, 0)  # B
-                    rx = rx_bytes - prev_rx_bytes.setdefault(name, 0)
+        if isLinux:
+            pipe.gauge(metrics['virtual.buffers'], virtual.buffers)
+            pipe.gauge(metrics['virtual.cached'], virtual.cached)
+
+
+# psutil field -> metric, for every NIC
+NETWORK_RATES = [
+    ('bytes_sent', 'send_rate'),  # B/s
+    ('bytes_recv', 'recv_rate'),
+    ('packets_sent', 'send_packet_rate'),  # /s
+    ('packets_recv', 'recv_packet_rate'),
+    ('errout', 'send_error_rate'),
+    ('errin', 'recv_error_rate'),
+    ('dropout', 'send_drop_rate'),
+    ('dropin', 'recv_drop_rate'),
+]
+
+network_rates = Rates()
+
+
+def network(batch, metrics, nic, debug=False):
+    counters = sysinfo.net_io_counters(True)
+    now = time.time()
+    with batch.pipeline() as pipe:
+        for name, net in counters.items():
+            rates = network_rates.update(name, [getattr(net, field) for field, _ in NETWORK_RATES], now)
+
+            if name == nic:
+                # The main NIC also keeps its original, untagged, series
+                if rates is not None:
+                    pipe.gauge(metrics['send_rate'], rates[0] or 0)
+                    pipe.gauge(metrics['recv_rate'], rates[1] or 0)
+                pipe.gauge(metrics['send_errors'], net.errout)
+                pipe.gauge(metrics['recv_errors'], net.errin)
+
+            if rates is not None:
+                for (_, metric), rate in zip(NETWORK_RATES, rates):
+                    if rate is not None:
+                        pipe.gauge(metrics[metric, ('nic', name)], rate)
+
+        for name in [name for name in network_rates.slots if name not in counters]:
+            network_rates.discard(name)
+
+
+def misc(batch, metrics, debug=False):
+    boot_time = sysinfo.boot_time()
+    uptime = time.time() - boot_time
+    with batch.pipeline() as pipe:
+        pipe.gauge(metrics['uptime'], uptime)
+        if debug:
+            log.debug("uptime={}".format(uptime))
 
-                    timer = time.time()
-                    elapsed = timer - prev_timer.get(name, 0)  # s
-                    prev_timer[name] = timer
+        pipe.gauge(metrics['users'], len(psutil.users()))
+        pipe.gauge(metrics['processes'], len(sysinfo.pids()))
 
-                    tx_rate = tx / elapsed if tx > 0 and elapsed > 0 else 0  # B/s
-                    rx_rate = rx / elapsed if rx > 0 and elapsed > 0 else 0
 
-                    pipe.gauge('system.network.send_rate,service={}'.format(name), tx_rate)
-                    pipe.gauge('system.network.recv_rate,service={}'.format(name), rx_rate)
+process_table = None
 
-                    if debug:
-                        log.debug("{}: Net Tx: {:,} -> {:,} ({}B/s)".format(name, tx_bytes, prev_tx_bytes[name], tx_rate))
-                        log.debug("{}: Net Rx: {:,} -> {:,} ({}B/s)".format(name, rx_bytes, prev_rx_bytes[name], rx_rate))
 
-                    prev_tx_bytes[name] = tx_bytes
-                    prev_rx_bytes[name] = rx_bytes
+def processes(batch, metrics, top, debug=False):
+    global process_table
 
-                    pipe.gauge('system.disk.root.percent,service={}'.format(name), 0)
+    if process_table is None:
+        from processes import ProcessTable
 
-            elapsed = time.time() - start
-            log.debug("docker: {}ms".format(int(elapsed * 1000)))
-            time.sleep(interval - elapsed)
+        process_table = ProcessTable()
+    start = time.time()
+    process_table.update()
+    if debug:
+        log.debug("processes: {} in {}ms".format(len(process_table.tracked), int((time.time() - start) * 1000)))
+
+    with batch.pipeline() as pipe:
+        for name, percent in process_table.top_cpu(top):
+            pipe.gauge(metrics['cpu.percent', ('process', name)], percent)
+        for name, rss in process_table.top_rss(top):
+            pipe.gauge(metrics['memory.rss', ('process', name)], rss)
+
+
+TRANSPORT_COUNTERS = ['sent', 'bytes', 'packets', 'flushes', 'dropped', 'suppressed']
+
+agent_process = None
+agent_counters = {}
+
+
+# The agent's own footprint and what its transport did since the last call
+def agent(batch, metrics, transport, debug=False):
+    global agent_process
+
+    if agent_process is None:
+        agent_process = psutil.Process()
+        agent_process.cpu_percent()  # the first call only starts the measure
+
+    with batch.pipeline() as pipe:
+        pipe.gauge(metrics['memory.rss'], agent_process.memory_info().rss)
+        pipe.gauge(metrics['cpu.percent'], agent_process.cpu_percent())
+        pipe.gauge(metrics['threads'], agent_process.num_threads())
+
+        sources = [(None, transport, TRANSPORT_COUNTERS, ())]
+        # And each server's share, behind a Router
+        for server in getattr(transport, 'transports', []):
+            destination = server.name.replace('.', '-').replace(':', '_').replace('/', '_').replace(',', '_')
+            sources.append((server.name, server, TRANSPORT_COUNTERS[:-1], (('destination', destination),)))
+
+        for key, source, names, tags in sources:
+            for name in names:
+                value = getattr(source, name)
+                last = agent_counters.get((key, name), 0)
+                if value > last:
+                    pipe.incr(metrics[('transport.' + name,) + tags], value - last)
+                agent_counters[key, name] = value
+            pipe.gauge(metrics[('transport.backlog',) + tags], source.backlog)
+
+
+# `metrics` is the metrics.Metrics of the prefix, with the fields as tags, in the wire format
+def collectors(metrics, nic, debug=False, top=0):
+    return [
+        ('misc', partial(misc, metrics=metrics, debug=debug)),
+        ('network', partial(network, metrics=metrics.under('network'), nic=nic, debug=debug)),
+        ('memory', partial(memory, metrics=metrics.under('memory'), debug=debug)),
+        ('cpu_times', partial(cpu_times, metrics=metrics.under('cpu'), debug=debug)),
+        ('cpu_times_percent', partial(cpu_times_percent, metrics=metrics.under('cpu'), debug=debug)),
+        ('cpu_cores', partial(cpu_cores, metrics=metrics.under('cpu'), threshold=core_threshold, gauges=core_gauges,
+                              debug=debug)),
+        ('disk', partial(disk, metrics=metrics.under('disk'), debug=debug)),
+    ] + ([('processes', partial(processes, metrics=metrics.under('process'), top=top, debug=debug))]
+         if top > 0 else [])
+
+
+COLLECTORS = [name for name, _ in collectors(Metrics(), None, top=1)]
+# What [intervals], [timeouts], -C and -T may name
+JOBS = COLLECTORS + ['docker']
+# Docker intervals a docker run may take before its stats are dropped: with many containers a
+# cycle takes longer than the interval, and then only runs late
+DOCKER_TIMEOUT = 4
+
+# Cheap enough to sample every second or so
+DEFAULT_AGGREGATE = 'network,cpu_times_percent,memory'
+
+
+def run_once(transport, metrics, nic, debug=False, top=0):
+    with transport.pipeline() as batch:
+        for name, collector in collectors(metrics, nic, debug, top):
+            collector(batch)
+
+
+# A single collection, for cron and timers. Rates and percentages are computed between two
+# samples: with a `window`, the collectors first run that many seconds earlier into a batch
+# that is never sent.
+def collect_once(transport, metrics, nic, debug=False, top=0, window=1):
+    if window > 0:
+        batch = transport.pipeline()
+        for name, collector in collectors(metrics, nic, debug, top):
+            collector(batch)
+        time.sleep(window)
+    run_once(transport, metrics, nic, debug, top)
+
+
+# Collectors named in `aggregated` are sampled every `sample_interval` seconds and only send a
+# summary of their samples at their own interval. With `agent_metrics` (the Metrics of the
+# agent prefix), the agent reports on itself every `agent_interval` seconds. With a `cpu_budget`
+# (percent of one core), collectors are sampled less often while the agent uses more than that.
+def schedule(transport, metrics, nic, intervals, timeouts, debug=False, sample_interval=0, aggregated=(),
+             percentiles=(), top=0, agent_metrics=None, agent_interval=10, cpu_budget=0, budget_window=60):
+    from aggregate import Aggregate
+    from scheduler import Governor, Scheduler
+
+    scheduler = Scheduler(transport, agent_metrics,
+                          Governor(cpu_budget / 100, budget_window) if cpu_budget > 0 else None)
+    for name, collector in collectors(metrics, nic, debug, top):
+        interval = intervals[name]
+        if name in aggregated and 0 < sample_interval < interval:
+            collector = Aggregate(collector, interval, sample_interval, percentiles)
+            interval = sample_interval
+        scheduler.add(name, collector, interval, timeouts.get(name))
+    if agent_metrics is not None:
+        scheduler.add('agent', partial(agent, metrics=agent_metrics, transport=transport, debug=debug),
+                      agent_interval)
+    return scheduler
+
+
+def profile(path, cycles, interval, transport, metrics, nic, debug=False, top=0):
+    import cProfile
+
+    profiler = cProfile.Profile()
+    for cycle in range(cycles):
+        start = time.time()
+        profiler.enable()
+        run_once(transport, metrics, nic, debug, top)
+        profiler.disable()
+        if cycle < cycles - 1:
+            time.sleep(max(0, interval - (time.time() - start)))
+    profiler.dump_stats(path)
+
+
+CONTAINER_RATES = ['cpu_total', 'cpu_system', 'periods', 'throttled_periods',
+                   'tx_bytes', 'rx_bytes', 'read_bytes', 'write_bytes']
+
+# Intervals after which the counters of a container without new stats are forgotten
+CONTAINER_TTL = 10
+
+# metric (under system.) -> rate sent as is
+CONTAINER_GAUGES = [
+    ('network.send_rate', 'tx_bytes'),  # B/s
+    ('network.recv_rate', 'rx_bytes'),
+    ('disk.read_rate', 'read_bytes'),
+    ('disk.write_rate', 'write_bytes'),
+]
+
+
+# Container stats, collected once per call into the batch, as system.* metrics tagged with the
+# service (container) name, in the wire `format`. With `agent_metrics`, its own costs go there too.
+# With a `core_threshold`, the container's per-core CPU is summarized like cpu_cores does. The
+# daemon connections, the container index and the stats streams are set up on the first call, and
+# torn down when a collection fails or the events stream died, for the next call to start over.
+class DockerCollector(object):
+    def __init__(self, address, interval, concurrency=8, stream=False, resync=300, cgroup_root=None,
+                 debug=False, agent_metrics=None, format='influx', core_threshold=None):
+        self.address = address
+        self.interval = interval
+        self.concurrency = concurrency
+        self.stream = stream
+        self.resync = resync
+        self.cgroup_root = cgroup_root
+        self.debug = debug
+        self.agent_metrics = agent_metrics
+        self.format = format
+        self.process = psutil.Process()
+        self.rates = Rates()
+        self.core_threshold = core_threshold
+        self.metrics = {}  # container ID -> its Metrics
+        self.core_usage = {}  # container ID -> its cores.CoreUsage
+        self.index = None
+        self.restarts = 0
+        self.reported_restarts = 0
+
+    def start(self):
+        from multiprocessing.pool import ThreadPool
+        from cgroup import Cgroups
+        from docker import ConnectionPool, ContainerIndex, StatsStreams
+
+        self.docker = ConnectionPool(self.address, self.concurrency, timeout=self.interval)
+        self.index = ContainerIndex(self.docker, self.resync)
+        self.index.start()
+        self.cgroups = Cgroups(self.cgroup_root) if self.cgroup_root else None
+        self.streams = StatsStreams(self.address, timeout=self.interval) if self.stream and not self.cgroups else None
+        self.workers = ThreadPool(self.concurrency) if not self.streams and not self.cgroups else None
+        self.reported_errors = 0
+
+    def stop(self):
+        self.index.stop()
+        for source in [self.streams, self.cgroups, self.docker]:
+            if source is not None:
+                source.close()
+        if self.workers is not None:
+            self.workers.terminate()
+        self.index = None
+
+    def __call__(self, batch):
+        if self.index is not None and not self.index.is_alive():
+            log.error("docker: the events stream stopped, restarting")
+            self.stop()
+            self.restarts += 1
+        if self.index is None:
+            self.start()
+        try:
+            self.collect(batch)
+        except Exception:
+            self.stop()
+            self.restarts += 1
+            raise
+
+    def fetch_stats(self, container):
+        start = time.time()
+        try:
+            stats = self.docker.get('/containers/{}/stats?stream=0'.format(container.get('Id')), self.debug)
+        except Exception as e:
+            log.error("{}: {}".format(container.get('Names')[0].strip('/'), e))
+            stats = None
+        return container, stats, time.time() - start
+
+    @staticmethod
+    def latest_stats(source, containers):
+        source.sync([container.get('Id') for container in containers])
+        samples = []
+        for container in containers:
+            start = time.time()
+            stats = source.get(container.get('Id'))
+            samples.append((container, stats, time.time() - start))
+        return samples
+
+    # Each core's share of one host core used by the container since its last sample
+    def cores(self, pipe, metrics, container_id, record):
+        from cores import CoreUsage, summarize
+
+        usage = self.core_usage.get(container_id)
+        if usage is None:
+            usage = self.core_usage[container_id] = CoreUsage()
+        # Older daemons list all the possible CPUs, the offline ones last
+        percents = usage.update(record['percpu'][:record['num_cpus']], record['cpu_system'] / record['num_cpus'])
+        if percents is not None:
+            for name, value in summarize(percents, self.core_threshold):
+                pipe.gauge(metrics['cpu.cores.' + name], value)
+
+    def collect(self, pipe):
+        from docker import is_running, stats_record
+
+        debug, agent_metrics, streams = self.debug, self.agent_metrics, self.streams
+        start = time.time()
+        containers = [container for container in self.index.containers(debug) if is_running(container)]
+        if self.cgroups is not None:
+            samples = self.latest_stats(self.cgroups, containers)
+        elif streams is not None:
+            samples = self.latest_stats(streams, containers)
+        else:
+            # Each stats call takes a second or two in the daemon, so they are made concurrently
+            samples = self.workers.imap_unordered(self.fetch_stats, containers)
+        failed = 0
+        for container, stats, latency in samples:
+            name = container.get('Names')[0].strip('/')
+            status = container.get('Status')
+            log.debug("{}: {}".format(name, status))
+            if agent_metrics is not None and streams is None:
+                pipe.timing(agent_metrics['docker.latency', ('service', name)], latency * 1000)
+            if stats is None:
+                failed += self.workers is not None
+                continue
 
-    except Exception as e:
-        log.exception(e)
+            # Made again after a docker rename: the service= tag is rendered into the metric names
+            metrics = self.metrics.get(container.get('Id'))
+            if metrics is None or metrics.tags != (('service', name),):
+                metrics = self.metrics[container.get('Id')] = Metrics('system', [('service', name)], self.format)
+
+            record = stats_record(stats)
+            # Keyed by ID: a container recreated under the same name starts over, and so does one
+            # whose counters went backwards (restarted). Over the daemon's sample times: a streamed
+            # sample can be up to a second old.
+            rates = dict(zip(CONTAINER_RATES, self.rates.update(container.get('Id'), [
+                record[key] for key in CONTAINER_RATES], record['read'], restart=True)
+                or [None] * len(CONTAINER_RATES)))
+
+            mem_usage = record['mem_usage']
+            mem_limit = record['mem_limit'] or 1
+            mem_percent = 100.0 * (mem_usage / mem_limit)
+
+            if debug:
+                log.debug("{}: Mem: {:,} {:,} {}%".format(name, mem_usage, mem_limit, mem_percent))
+
+            pipe.gauge(metrics['memory.virtual.percent'], mem_percent)
+            pipe.gauge(metrics['memory.virtual.used'], mem_usage)
+            pipe.gauge(metrics['memory.virtual.cached'], record['mem_cache'])
+            pipe.gauge(metrics['memory.virtual.rss'], record['mem_rss'])
+
+            # http://stackoverflow.com/questions/30271942/get-docker-container-cpu-usage-as-percentage
+            if streams is not None:
+                # Streamed samples come paired with the previous one, except the first of each
+                # connection: its precpu_stats are empty
+                cpu_delta = system_delta = None
+                if record['precpu_system']:
+                    cpu_delta = record['cpu_total'] - record['precpu_total']
+                    system_delta = record['cpu_system'] - record['precpu_system']
+            else:
+                # Rates over the same time: their ratio is the ratio of the deltas
+                cpu_delta, system_delta = rates['cpu_total'], rates['cpu_system']
+
+            if cpu_delta is not None and system_delta is not None:
+                cpu_percent = 0
+                if system_delta > 0 and cpu_delta > 0:
+                    cpu_percent = (cpu_delta / system_delta) * record['num_cpus'] * 100.0
+
+                if debug:
+                    log.debug("{}: Cpu: {}, {}: {}%".format(name, cpu_delta, system_delta, cpu_percent))
+
+                pipe.gauge(metrics['cpu.percent'], cpu_percent)
+
+            if self.core_threshold is not None and record['percpu'] and record['cpu_system']:
+                self.cores(pipe, metrics, container.get('Id'), record)
+
+            # Only with CFS periods counted: a container without a CPU quota, or a v1 cgroup without
+            # the cpu controller, has none to be throttled in
+            periods, throttled = rates['periods'], rates['throttled_periods']
+            if periods is not None and throttled is not None and record['periods']:
+                throttled_percent = 100.0 * throttled / periods if periods > 0 and throttled > 0 else 0
+                pipe.gauge(metrics['cpu.throttled.percent'], throttled_percent)
+
+            # All the container's interfaces
+            tx_rate, rx_rate = rates['tx_bytes'], rates['rx_bytes']  # B/s
+            if debug:
+                log.debug("{}: Net Tx: {:,} ({}B/s)".format(name, record['tx_bytes'], tx_rate))
+                log.debug("{}: Net Rx: {:,} ({}B/s)".format(name, record['rx_bytes'], rx_rate))
+
+            for metric, key in CONTAINER_GAUGES:
+                if rates[key] is not None:
+                    pipe.gauge(metrics[metric], rates[key])
+
+        ids = set(container.get('Id') for container in containers)
+        for container_id in [key for key in self.rates.slots if key not in ids]:
+            self.rates.discard(container_id)
+        for container_id in [key for key in self.metrics if key not in ids]:
+            del self.metrics[container_id]
+        for container_id in [key for key in self.core_usage if key not in ids]:
+            del self.core_usage[container_id]
+        # And those without a sample for a while
+        self.rates.expire(time.time() - CONTAINER_TTL * self.interval)
+
+        if agent_metrics is not None:
+            with pipe.pipeline() as agent_pipe:
+                # Failed stats requests of this cycle, plus what the other sources counted since the last one
+                errors = self.index.errors + sum(source.errors for source in [streams, self.cgroups] if source)
+                if failed + errors > self.reported_errors:
+                    agent_pipe.incr(agent_metrics['docker.errors'], failed + errors - self.reported_errors)
+                self.reported_errors = errors
+                agent_pipe.gauge(agent_metrics['docker.containers'], len(containers))
+                agent_pipe.gauge(agent_metrics['docker.memory.rss'], self.process.memory_info().rss)
+                if self.restarts > self.reported_restarts:
+                    agent_pipe.incr(agent_metrics['docker.restarts'], self.restarts - self.reported_restarts)
+                    self.reported_restarts = self.restarts
+                agent_pipe.timing(agent_metrics['docker.time'], (time.time() - start) * 1000)
+
+
+def run_docker(address, interval, transport, concurrency=8, stream=False, resync=300, cgroup_root=None,
+               debug=False, agent_metrics=None, format='influx', core_threshold=None):
+    collector = DockerCollector(address, interval, concurrency, stream, resync, cgroup_root, debug, agent_metrics,
+                                format, core_threshold)
+    while True:
+        start = time.time()
+        try:
+            with transport.pipeline() as batch:
+                collector(batch)
+        except Exception as e:
+            log.exception(e)
+        elapsed = time.time() - start
+        log.debug("docker: {}ms".format(int(elapsed * 1000)))
+        time.sleep(max(0, interval - elapsed))
 
 
 class StatsdConfig(RawConfigParser):
@@ -272,12 +626,42 @@ class StatsdConfig(RawConfigParser):
     def get_int(self, opt, section='statsd-agent', default=0):
         return to_int(self.get_str(opt, section), default)
 
+    def get_float(self, opt, section='statsd-agent', default=0.0):
+        return to_float(self.get_str(opt, section), default)
+
     def get_boolean(self, opt, section='statsd-agent', default=False):
         try:
             return self.getboolean(section, opt)
         except Error:
             return default
 
+    def get_list(self, opt, section='statsd-agent', default=''):
+        return [value.strip() for value in self.get_str(opt, section, default).split(',') if value.strip()]
+
+    def get_collector_ints(self, section, default=None, arg_values=None):
+        values = {}
+        try:
+            options = [(option, self.get(section, option)) for option in self.options(section)]
+        except Error:
+            options = []
+
+        for value in arg_values or []:
+            name, _, value = value.partition('=')
+            options.append((name, value))
+
+        for name, value in options:
+            if name not in JOBS:
+                log.error("Unknown collector in [{}]: {}".format(section, name))
+                continue
+            value = to_int(value, default)
+            if value is not None:
+                values[name] = value
+
+        if default is not None:
+            for name in COLLECTORS:
+                values.setdefault(name, default)
+        return values
+
     def get_fields(self, arg_fields=None, arg_add_host_field=True):
         if arg_fields is None:
             arg_fields = []
@@ -311,10 +695,8 @@ class StatsdConfig(RawConfigParser):
         if self.get_boolean('add-host-field', default=False) or arg_add_host_field and 'host' not in field_set:
             fields.append("host={}".format(socket.gethostname()))
 
-        fields = ','.join([f.replace(',', '_').replace(' ', '_').replace('.', '-') for f in fields])
-        if fields and not fields.endswith(','):
-            fields = ',' + fields
-        return fields
+        # (key, value) tags, put on the wire by metrics.Metric
+        return [tuple(f.replace(',', '_').replace(' ', '_').replace('.', '-').split('=', 1)) for f in fields]
 
 
 def get_nic(netiface):
@@ -369,6 +751,8 @@ if isWindows:
             servicemanager.LogInfoMsg(str(msg))
 
         def SvcDoRun(self):
+            global core_threshold, core_gauges
+
             self.log("Starting...")
             self.ReportServiceStatus(win32service.SERVICE_START_PENDING)
             cfg_file = 'C:\\statsd-agent\\statsd-agent.cfg'
@@ -380,34 +764,58 @@ if isWindows:
             config = StatsdConfig(allow_no_value=True)
             config.read(cfg_file)
             fields = config.get_fields()
+            metric_format = config.get_str('format', default='influx')
             nic = get_nic(config.get_str('nic'))
-            interval, rc = config.get_int('interval', default=10) - 2, None
+            interval = config.get_int('interval', default=10)
             host = config.get_str('host', default='localhost')
             port = config.get_int('port', default=8125)
             prefix = config.get_str('prefix', default='system')
             debug = config.get_boolean('debug', default=False)
+            core_threshold = config.get_float('core-threshold', default=90)
+            core_gauges = config.get_boolean('core-gauges', default=False)
+            suppress = None
+            if config.get_boolean('suppress', default=False):
+                suppress = Suppressor(config.get_float('suppress-epsilon', default=0.0),
+                                      config.get_int('refresh', default=10))
+            transport = make_transport(config.get_str('transport', default='udp'), host, port,
+                                       mtu=config.get_int('mtu', default=1432),
+                                       dns_ttl=config.get_int('dns-ttl', default=300), suppress=suppress,
+                                       buffer=config.get_int('buffer', default=10000),
+                                       destinations=config.get_list('destinations'),
+                                       routing=config.get_str('routing', default='shard'))
+            agent_prefix = config.get_str('agent-prefix', default='agent')
+            scheduler = schedule(transport, Metrics(prefix, fields, metric_format), nic,
+                                 config.get_collector_ints('intervals', interval),
+                                 config.get_collector_ints('timeouts'), debug,
+                                 config.get_int('sample-interval', default=0),
+                                 config.get_list('aggregate', default=DEFAULT_AGGREGATE),
+                                 [to_int(p, 0) for p in config.get_list('percentiles')],
+                                 config.get_int('top', default=0),
+                                 Metrics(agent_prefix, fields, metric_format) if agent_prefix else None, interval,
+                                 config.get_float('cpu-budget', default=0),
+                                 config.get_int('cpu-budget-window', default=60))
+
+            def wait(seconds):
+                return win32event.WaitForSingleObject(self.hWaitStop, int(seconds * 1000)) == win32event.WAIT_OBJECT_0
 
             self.ReportServiceStatus(win32service.SERVICE_RUNNING)
 
-            while rc != win32event.WAIT_OBJECT_0:
-                try:
-                    run_once(host, port, prefix, fields, nic, debug)
-                except:
-                    servicemanager.LogErrorMsg(traceback.format_exc())
-
-                rc = win32event.WaitForSingleObject(self.hWaitStop, interval * 1000)
+            try:
+                scheduler.run(wait)
+            except:
+                servicemanager.LogErrorMsg(traceback.format_exc())
 
             self.log("Stopped.")
             self.ReportServiceStatus(win32service.SERVICE_STOPPED)
 
 
 def main():
+    global sysinfo, core_threshold, core_gauges
+
     if isWindows:
         win32serviceutil.HandleCommandLine(StatsdAgentService)
 
     else:
-        import multiprocessing
-
         config = StatsdConfig(allow_no_value=True)
         config.read('statsd-agent.cfg')
 
@@ -416,14 +824,79 @@ def main():
                             help='Hostname or IP of statsd/statsite server.')
         parser.add_argument('--port', '-p', type=int, default=config.get_int('port', default=8125),
                             help='UDP port number of statsd/statsite server.')
+        parser.add_argument('--transport', choices=TRANSPORTS,
+                            default=config.get_str('transport', default='udp'),
+                            help='How to reach statsd/statsite. With unix, --host is the path of its socket.')
+        parser.add_argument('--destination', action='append', default=[],
+                            help="One or more 'host:port' statsd/statsite servers, instead of --host and --port "
+                                 "(default: the destinations= of the config). Paths with --transport unix.")
+        parser.add_argument('--routing', choices=ROUTING, default=config.get_str('routing', default='shard'),
+                            help='With several destinations, send each series to one of them (shard) or '
+                                 'everything to all of them (mirror).')
+        parser.add_argument('--buffer', type=int, default=config.get_int('buffer', default=10000),
+                            help='Maximum number of stats queued while the tcp server is unreachable.')
+        parser.add_argument('--mtu', type=int, default=config.get_int('mtu', default=1432),
+                            help='Maximum size in bytes of each datagram sent to statsd/statsite.')
+        parser.add_argument('--dns-ttl', type=int, default=config.get_int('dns-ttl', default=300),
+                            help='Time in seconds before the statsd/statsite hostname is resolved again.')
         parser.add_argument('--prefix', '-x', type=str, default=config.get_str('prefix'),
                             help='Prefix value to add to each measurement.')
         parser.add_argument('--field', '-f', action='append', default=[],
                             help="One or more 'key=value' fields to add to each measurement.")
+        parser.add_argument('--format', choices=FORMATS, default=config.get_str('format', default='influx'),
+                            help='How the fields go on the wire: influx (name,key=value:1|g), dogstatsd '
+                                 '(name:1|g|#key:value) or plain (name.value:1|g).')
         parser.add_argument('--network', '--nic', '-n', type=str,
                             default=config.get_str('nic'), help='NIC to measure.')
         parser.add_argument('--interval', '-i', type=int, default=config.get_int('interval', default=10),
-                            help='Time in seconds between system measurements. Must be > 2.')
+                            help='Time in seconds between system measurements. Must be >= 1.')
+        parser.add_argument('--collector-interval', '-C', action='append', default=[],
+                            help="One or more 'collector=seconds' overrides of --interval for single collectors.")
+        parser.add_argument('--collector-timeout', '-T', action='append', default=[],
+                            help="One or more 'collector=seconds' limits on a single collection "
+                                 "(default: the collector's interval, {} times it for docker).".format(DOCKER_TIMEOUT))
+        parser.add_argument('--sample-interval', type=int, default=config.get_int('sample-interval', default=0),
+                            help='Time in seconds between samples of the --aggregate collectors, which then only '
+                                 'send the min/max/avg/last of their samples at their interval. 0 disables.')
+        parser.add_argument('--aggregate', type=str,
+                            default=','.join(config.get_list('aggregate', default=DEFAULT_AGGREGATE)),
+                            help="Comma separated collectors to sample every --sample-interval.")
+        parser.add_argument('--percentiles', type=str, default=','.join(config.get_list('percentiles')),
+                            help="Comma separated percentiles to add to the aggregated metrics, e.g. 95,99.")
+        parser.add_argument('--backend', choices=['psutil', 'proc'],
+                            default=config.get_str('backend', default='psutil'),
+                            help='Read the host stats with psutil, or on Linux, from /proc files kept open.')
+        parser.add_argument('--core-threshold', type=float,
+                            default=config.get_float('core-threshold', default=90),
+                            help='Busy percentage over which a core counts in cpu.cores.saturated.')
+        parser.add_argument('--core-gauges', action='store_true',
+                            help='Also send the busy percentage of every core, not only their summary.')
+        parser.add_argument('--top', type=int, default=config.get_int('top', default=0),
+                            help='Report the CPU and RSS of this many busiest programs. 0 disables.')
+        parser.add_argument('--suppress', action='store_true',
+                            help="Don't resend gauges whose value has not changed since they were last sent.")
+        parser.add_argument('--suppress-epsilon', type=float,
+                            default=config.get_float('suppress-epsilon', default=0.0),
+                            help='Relative change under which a gauge counts as unchanged, e.g. 0.01 for 1%%.')
+        parser.add_argument('--refresh', type=int, default=config.get_int('refresh', default=10),
+                            help='Send every gauge at least once every this many collections when suppressing.')
+        parser.add_argument('--cpu-budget', type=float, default=config.get_float('cpu-budget', default=0),
+                            help="Percent of one core the agent may use, e.g. 1. Over it, the costliest collectors "
+                                 "(docker, then disk, then by CPU time) are run less often. 0 disables.")
+        parser.add_argument('--cpu-budget-window', type=int,
+                            default=config.get_int('cpu-budget-window', default=60),
+                            help='Time in seconds over which the CPU use is measured against --cpu-budget.')
+        parser.add_argument('--agent-prefix', type=str, default=config.get_str('agent-prefix', default='agent'),
+                            help="Prefix of the agent's own metrics (timings, errors, traffic). Empty disables them.")
+        parser.add_argument('--once', action='store_true',
+                            help='Collect once, send and exit, e.g. from cron or a systemd timer. Without docker.')
+        parser.add_argument('--once-window', type=float, default=1,
+                            help='Seconds between the two samples --once takes to compute rates and percentages. '
+                                 '0 sends only what a single sample gives.')
+        parser.add_argument('--profile', type=int, default=0, metavar='CYCLES',
+                            help='Run this many cycles of all the collectors, one after the other, under cProfile, '
+                                 'write the result to --profile-file and exit.')
+        parser.add_argument('--profile-file', type=str, default='statsd-agent.prof')
         parser.add_argument('--add-host-field', '-a', action='store_true', help='Auto add host= to fields.')
         parser.add_argument('--debug', '-g', action='store_true', help="Turn on debugging.")
         parser.add_argument('--docker', '-d', action='store_true', help="Enable docker")
@@ -431,9 +904,25 @@ def main():
                                                                                     default='/var/run/docker.sock'))
         parser.add_argument('--docker-interval', '-I', type=int, default=config.get_int('interval', 'docker', default=15),
                             help='Time in seconds between docker measurements. Must be > 2.')
+        parser.add_argument('--docker-stream', action='store_true',
+                            help='Keep one streaming stats connection open per running container instead of polling.')
+        parser.add_argument('--docker-backend', choices=['api', 'cgroup'],
+                            default=config.get_str('backend', 'docker', default='api'),
+                            help='Read container stats from the docker API or directly from the cgroup filesystem.')
+        parser.add_argument('--cgroup-root', type=str, default=config.get_str('cgroup-root', 'docker',
+                                                                              default='/sys/fs/cgroup'))
+        parser.add_argument('--docker-resync', type=int, default=config.get_int('resync', 'docker', default=300),
+                            help='Time in seconds between full re-listings of the running containers.')
+        parser.add_argument('--docker-cores', action='store_true',
+                            help="Summarize each container's per-core CPU, like cpu.cores.* of the host.")
+        parser.add_argument('--docker-concurrency', type=int, default=config.get_int('concurrency', 'docker', default=8),
+                            help='Maximum number of concurrent docker stats requests.')
 
         args = parser.parse_args()
         docker = config.get_boolean('enabled', 'docker', default=False) or args.docker
+        docker_stream = config.get_boolean('stream', 'docker', default=False) or args.docker_stream
+        docker_cores = config.get_boolean('cores', 'docker', default=False) or args.docker_cores
+        suppress = config.get_boolean('suppress', default=False) or args.suppress
         debug = config.get_boolean('debug', default=False) or args.debug
         prefix = args.prefix if args.prefix else ''
 
@@ -446,30 +935,126 @@ def main():
         if debug:
             log.debug("fields: {}".format(fields))
 
-        if args.interval < 3:
-            log.error("Invalid system interval (< 3sec).")
+        if args.format not in FORMATS:
+            log.error("Unknown format: {} (not one of {}).".format(args.format, ', '.join(FORMATS)))
+            return 1
+        metrics = Metrics(prefix, fields, args.format)
+        agent_metrics = Metrics(args.agent_prefix, fields, args.format) if args.agent_prefix else None
+
+        if args.interval < 1:
+            log.error("Invalid system interval (< 1sec).")
+            return 1
+
+        for value in args.collector_interval + args.collector_timeout:
+            name, sep, seconds = value.partition('=')
+            if not sep or to_int(seconds, None) is None:
+                log.error("Invalid collector override: {} (expected collector=seconds).".format(value))
+                return 1
+
+        intervals = config.get_collector_ints('intervals', args.interval, args.collector_interval)
+        timeouts = config.get_collector_ints('timeouts', arg_values=args.collector_timeout)
+        if min(intervals.values()) < 1 or timeouts and min(timeouts.values()) < 1:
+            log.error("Invalid collector interval or timeout (< 1sec).")
+            return 1
+
+        if debug:
+            log.debug("intervals: {}".format(intervals))
+
+        aggregated = [name.strip() for name in args.aggregate.split(',') if name.strip()]
+        percentiles = [to_int(p, 0) for p in args.percentiles.split(',') if p.strip()]
+        if set(aggregated) - set(COLLECTORS):
+            log.error("Unknown collector(s) to aggregate: {}".format(', '.join(set(aggregated) - set(COLLECTORS))))
+            return 1
+        if args.top < 0:
+            log.error("Invalid top (< 0).")
             return 1
 
-        if args.docker_interval < 3:
+        if not 0 <= args.core_threshold <= 100:
+            log.error("Invalid core threshold (not between 0 and 100).")
+            return 1
+        core_threshold = args.core_threshold
+        core_gauges = config.get_boolean('core-gauges', default=False) or args.core_gauges
+
+        if args.sample_interval < 0 or not all(0 < p < 100 for p in percentiles):
+            log.error("Invalid sample interval (< 0) or percentile (not between 0 and 100).")
+            return 1
+
+        docker_interval = intervals.get('docker', args.docker_interval)
+        if docker_interval < 3:
             log.error("Invalid docker interval (< 3sec).")
             return 1
 
+        if args.docker_concurrency < 1:
+            log.error("Invalid docker concurrency (< 1).")
+            return 1
+
         nic = get_nic(args.network)
         if not nic:
             log.error("Could not locate 10.x.x.x network interface!")
             return 1
 
+        if args.suppress_epsilon < 0 or args.refresh < 1:
+            log.error("Invalid suppress epsilon (< 0) or refresh (< 1).")
+            return 1
+
+        if args.buffer < 1:
+            log.error("Invalid buffer (< 1).")
+            return 1
+
+        destinations = args.destination or config.get_list('destinations')
+        try:
+            for destination in destinations:
+                parse_destination(destination, args.port, args.transport)
+        except ValueError:
+            log.error("Invalid destination: {} (not host:port).".format(destination))
+            return 1
+
+        if args.cpu_budget < 0 or args.cpu_budget_window < 1:
+            log.error("Invalid CPU budget (< 0) or budget window (< 1sec).")
+            return 1
+
+        if args.once_window < 0:
+            log.error("Invalid once window (< 0).")
+            return 1
+
+        if args.backend == 'proc':
+            if not isLinux:
+                log.error("The proc backend is Linux only.")
+                return 1
+            from procfs import ProcFS
+
+            try:
+                sysinfo = ProcFS()
+            except (IOError, OSError) as e:
+                log.error("Could not open /proc: {}".format(e))
+                return 1
+
+        transport = make_transport(args.transport, args.host, args.port, mtu=args.mtu, dns_ttl=args.dns_ttl,
+                                   suppress=Suppressor(args.suppress_epsilon, args.refresh) if suppress else None,
+                                   buffer=args.buffer, destinations=destinations, routing=args.routing)
+
+        if args.once:
+            collect_once(transport, metrics, nic, debug, args.top, args.once_window)
+            return 0
+
+        if args.profile > 0:
+            profile(args.profile_file, args.profile, args.interval, transport, metrics, nic, debug, args.top)
+            return 0
+
+        scheduler = schedule(transport, metrics, nic, intervals, timeouts, debug,
+                             args.sample_interval, aggregated, percentiles, args.top,
+                             agent_metrics, args.interval, args.cpu_budget, args.cpu_budget_window)
         if docker:
-            multiprocessing.Process(target=run_docker,
-                                    args=(args.docker_addr, args.docker_interval, args.host, args.port, debug)).start()
+            # In the same process and through the same transport, on its own worker thread
+            scheduler.add('docker', DockerCollector(args.docker_addr, docker_interval, args.docker_concurrency,
+                                                    docker_stream, args.docker_resync,
+                                                    args.cgroup_root if args.docker_backend == 'cgroup' else None,
+                                                    debug, agent_metrics, args.format,
+                                                    args.core_threshold if docker_cores else None),
+                          docker_interval, timeouts.get('docker', docker_interval * DOCKER_TIMEOUT))
 
         try:
-            while True:
-                start = time.time()
-                run_once(args.host, args.port, prefix, fields, nic, debug)
-                elapsed = time.time() - start
-                log.debug("statsd: {}ms".format(int(elapsed * 1000)))
-                time.sleep(args.interval - elapsed)
+            scheduler.run()
         except KeyboardInterrupt:
             pass
 
@@ -0,0 +1,457 @@
+import bisect
+import hashlib
+import random
+import socket
+import struct
+import time
+from collections import deque
+
+import statsd
+try:
+    from statsd.client import Pipeline
+except ImportError:  # statsd 4 moved the clients into a package
+    from statsd.client.udp import Pipeline
+
+from common import log
+from metrics import Metric
+
+
+# Nested batches carry their own prefix and hand their stats back to the parent unpacked,
+# so a whole collection pass is packed into as few datagrams as fit the MTU in one go.
+class Batch(Pipeline):
+
+    def __init__(self, client, prefix=None):
+        super(Batch, self).__init__(client)
+        self._prefix = prefix
+
+    def pipeline(self, prefix=None):
+        return Batch(self, prefix)
+
+    # A Metric already carries its prefix and tags: only the value is left to format. Plain
+    # gauges, nearly all of what the collectors send, skip statsd's generic path.
+    def gauge(self, stat, value, rate=1, delta=False):
+        if rate >= 1 and not delta and value >= 0 and isinstance(stat, Metric):
+            self._stats.append(stat.head + str(value) + stat.gauge)
+        else:
+            super(Batch, self).gauge(stat, value, rate, delta)
+
+    def _prepare(self, stat, value, rate):
+        if not isinstance(stat, Metric):
+            return super(Batch, self)._prepare(stat, value, rate)
+        if rate < 1:
+            if random.random() > rate:
+                return
+            value = '{}|@{}'.format(value, rate)
+        return stat.head + value + stat.tail
+
+    def extend(self, other):
+        self._stats.extend(other._stats)
+        other._stats.clear()
+
+    def _filter(self):
+        if self._client._suppress is not None:
+            self._stats = deque(self._client._suppress.filter(self._stats))
+        return bool(self._stats)
+
+    def _send(self):
+        if isinstance(self._client, Batch):
+            self._client.extend(self)
+            return
+
+        if not self._filter():
+            return
+        super(Batch, self)._send()
+        self._client.flushes += 1
+        self._client.flush()
+
+
+# The top-level batch of a Router: each stat goes to the batch of its destination(s), which is
+# then packed and sent like any other.
+class RoutedBatch(Batch):
+
+    def _send(self):
+        if not self._filter():
+            return
+        router = self._client
+        for transport, stats in router.route(self._stats):
+            batch = transport.pipeline()
+            batch._stats = stats
+            batch.send()
+        self._stats.clear()
+        router.flushes += 1
+
+
+# A stat as its name, its series (the name and any DogStatsD tags, which come after the value)
+# and its value with the type: "cpu:5|g|#host:a" -> "cpu", "cpu|#host:a", "5|g"
+def split(stat):
+    name, _, value = stat.partition(':')
+    value, sep, tags = value.partition('|#')
+    return name, name + sep + tags if sep else name, value
+
+
+# Under python 2 the stats are already bytes
+def encode(data):
+    return data if isinstance(data, bytes) else data.encode('ascii')
+
+
+# Drops gauges whose value has not moved by more than `epsilon` (relative to the value last sent)
+# since they were last sent. Each gauge still goes out at least once every `refresh` collections so
+# that the backend never loses the series. The series of containers and NICs that are gone are
+# swept out: those not seen since the previous sweep, every SWEEP seconds.
+class Suppressor(object):
+    SWEEP = 300
+
+    def __init__(self, epsilon=0.0, refresh=10):
+        self.epsilon = epsilon
+        self.refresh = refresh
+        self.last = {}  # series -> [value last sent, collections suppressed since, generation last seen]
+        self.generation = 0
+        self.swept = time.time()
+        self.sent = 0
+        self.suppressed = 0
+
+    def _unchanged(self, old, new):
+        if old == new:
+            return True
+        if not self.epsilon:
+            return False
+        try:
+            old = float(old)
+            return abs(float(new) - old) <= self.epsilon * abs(old)
+        except ValueError:
+            return False
+
+    def filter(self, stats):
+        stats = list(stats)
+        kept = []
+        for i, stat in enumerate(stats):
+            name, series, value = split(stat)
+            # Counters, timers and relative gauges always go out. A negative gauge is sent as
+            # "0|g" then "-n|g", and the pair must not be split.
+            if (not value.endswith('|g') or value.startswith(('+', '-')) or
+                    i + 1 < len(stats) and stats[i + 1].startswith(name + ':-')):
+                self.last.pop(series, None)
+                kept.append(stat)
+                continue
+
+            value = value[:-2]
+            last = self.last.get(series)
+            if last is not None and last[1] < self.refresh - 1 and self._unchanged(last[0], value):
+                last[1] += 1
+                last[2] = self.generation
+                continue
+            self.last[series] = [value, 0, self.generation]
+            kept.append(stat)
+
+        self.sent += len(kept)
+        self.suppressed += len(stats) - len(kept)
+        if len(kept) < len(stats):
+            log.debug("suppressed {} unchanged of {} stats".format(len(stats) - len(kept), len(stats)))
+        if time.time() - self.swept >= self.SWEEP:
+            self.sweep()
+        return kept
+
+    def sweep(self):
+        for series in [series for series, last in self.last.items() if last[2] < self.generation]:
+            del self.last[series]
+        self.generation += 1
+        self.swept = time.time()
+
+
+# One socket for the life of the agent. The server address is re-resolved every dns_ttl
+# seconds; if that fails the last known address keeps being used. With a Suppressor, unchanged
+# gauges are left out of each batch.
+class Transport(statsd.StatsClient):
+
+    def __init__(self, host='localhost', port=8125, prefix=None, mtu=1432, dns_ttl=300, ipv6=False,
+                 suppress=None):
+        self._host = host
+        self._port = port
+        self._fam = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self._prefix = prefix
+        self._maxudpsize = mtu
+        self._dns_ttl = dns_ttl
+        self._addr = None
+        self._resolved_at = 0
+        self._sock = None
+        self._suppress = suppress
+        self.dropped = 0  # stats lost on the way out
+        self.sent = self.bytes = self.packets = self.flushes = 0
+        self._resolve()
+
+    _type = socket.SOCK_DGRAM
+
+    def _resolve(self):
+        try:
+            family, _, _, _, addr = socket.getaddrinfo(self._host, self._port, self._fam, self._type)[0]
+        except socket.error as e:
+            log.error("Could not resolve {}:{}: {}".format(self._host, self._port, e))
+            self._resolved_at = time.time()
+            return
+
+        if self._sock is None or self._sock.family != family:
+            if self._sock is not None:
+                self._sock.close()
+            self._sock = socket.socket(family, self._type)
+
+        self._family = family
+        if self._addr is not None and addr != self._addr:
+            # Not the first one: a quiet run must not set up syslog for it
+            log.debug("statsd server {}:{} -> {}".format(self._host, self._port, addr[0]))
+        self._addr = addr
+        self._resolved_at = time.time()
+
+    def _send(self, data):
+        if self._addr is None or time.time() - self._resolved_at >= self._dns_ttl:
+            self._resolve()
+            if self._addr is None:
+                return
+        try:
+            self._sock.sendto(encode(data), self._addr)
+            self._sent(data)
+        except (socket.error, RuntimeError):
+            self.dropped += data.count('\n') + 1
+
+    def _sent(self, data, count=None):
+        self.sent += data.count('\n') + 1 if count is None else count
+        self.bytes += len(data)
+        self.packets += 1
+
+    @property
+    def name(self):
+        return '{}:{}'.format(self._host, self._port)
+
+    # Called at the end of every top-level batch
+    def flush(self):
+        pass
+
+    @property
+    def backlog(self):
+        return 0
+
+    @property
+    def suppressed(self):
+        return self._suppress.suppressed if self._suppress is not None else 0
+
+    def pipeline(self, prefix=None):
+        return Batch(self, prefix)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+
+
+# For a statsite on the same host: a Unix datagram socket, `host` being its path.
+class UnixTransport(Transport):
+
+    def __init__(self, host, port=None, prefix=None, mtu=1432, dns_ttl=None, ipv6=False, suppress=None):
+        self._host = self._addr = host
+        self._prefix = prefix
+        self._maxudpsize = mtu
+        self._suppress = suppress
+        self.dropped = 0
+        self.sent = self.bytes = self.packets = self.flushes = 0
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    @property
+    def name(self):
+        return self._host
+
+    def _send(self, data):
+        try:
+            self._sock.sendto(encode(data), self._addr)
+            self._sent(data)
+        except socket.error:  # no listener, or its buffer is full
+            self.dropped += data.count('\n') + 1
+
+
+# Stats are queued in a ring of at most `buffer` stats (the oldest are dropped first) and written
+# to a TCP connection at the end of each batch. While the server is unreachable they stay queued
+# and the connection is retried with exponential backoff.
+class TCPTransport(Transport):
+    MAX_BACKOFF = 30
+    TIMEOUT = 2
+
+    _type = socket.SOCK_STREAM
+
+    def __init__(self, host='localhost', port=8125, prefix=None, mtu=1432, dns_ttl=300, ipv6=False,
+                 suppress=None, buffer=10000):
+        self._ring = deque(maxlen=buffer)
+        self._connected = False
+        self._retry_at = 0
+        self._backoff = 1
+        super(TCPTransport, self).__init__(host, port, prefix, mtu, dns_ttl, ipv6, suppress)
+
+    def _send(self, data):
+        lines = data.split('\n')
+        overflow = len(self._ring) + len(lines) - self._ring.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+        self._ring.extend(lines)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._connected = False
+
+    def _connect(self):
+        if self._sock is None or time.time() - self._resolved_at >= self._dns_ttl:
+            self._resolve()
+        if self._addr is None:
+            return False
+        if self._sock is None:  # could not resolve again, use the last address
+            self._sock = socket.socket(self._family, self._type)
+        self._sock.settimeout(self.TIMEOUT)
+        self._sock.connect(self._addr)
+        self._connected = True
+        log.debug("statsd server {}:{} connected".format(self._host, self._port))
+        return True
+
+    def flush(self):
+        if not self._ring or time.time() < self._retry_at:
+            return
+
+        try:
+            if not self._connected and not self._connect():
+                return
+            data = '\n'.join(self._ring) + '\n'
+            self._sock.sendall(encode(data))
+            self._sent(data, len(self._ring))
+            self._ring.clear()
+            self._backoff = 1
+        except socket.error as e:
+            log.error("statsd server {}:{}: {} ({} stats queued, retrying in {}s)".format(
+                self._host, self._port, e, len(self._ring), self._backoff))
+            self._disconnect()
+            self._retry_at = time.time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+
+    @property
+    def backlog(self):
+        return len(self._ring)
+
+    def close(self):
+        self.flush()
+        self._disconnect()
+
+
+# Several statsd servers behind one transport. In shard mode each series (the stat name with its
+# tags) always goes to the same server, placed on a consistent hash ring so that adding or
+# removing a server only moves the series of its share of the ring. In mirror mode every server
+# gets everything. Gauges are suppressed once, before routing; each server keeps its own counters.
+class Router(object):
+    REPLICAS = 160  # points of each server on the ring
+    MAX_CACHED = 100000  # series whose server is remembered
+
+    def __init__(self, transports, mode='shard', suppress=None):
+        self.transports = transports
+        self.mode = mode
+        self._prefix = None
+        self._maxudpsize = min(transport._maxudpsize for transport in transports)
+        self._suppress = suppress
+        self.flushes = 0
+        self._ring = sorted((hash32('{}-{}'.format(transport.name, i)), index)
+                            for index, transport in enumerate(transports) for i in range(self.REPLICAS))
+        self._points = [point for point, _ in self._ring]
+        self._cache = {}  # series -> index of its transport
+
+    def shard(self, name):
+        index = self._cache.get(name)
+        if index is None:
+            if len(self._cache) >= self.MAX_CACHED:
+                self._cache.clear()
+            point = bisect.bisect(self._points, hash32(name)) % len(self._ring)
+            index = self._cache[name] = self._ring[point][1]
+        return index
+
+    # Yields each transport with its share of the stats
+    def route(self, stats):
+        if self.mode == 'mirror':
+            for transport in self.transports:
+                yield transport, deque(stats)
+            return
+
+        shares = [deque() for _ in self.transports]
+        for stat in stats:
+            # The "0|g" and "-n|g" of a negative gauge have the same name, and stay in order
+            shares[self.shard(split(stat)[1])].append(stat)
+        for transport, share in zip(self.transports, shares):
+            if share:
+                yield transport, share
+
+    def pipeline(self, prefix=None):
+        return RoutedBatch(self, prefix)
+
+    def flush(self):
+        for transport in self.transports:
+            transport.flush()
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+    @property
+    def suppressed(self):
+        return self._suppress.suppressed if self._suppress is not None else 0
+
+    # The totals of all the servers
+    @property
+    def sent(self):
+        return sum(transport.sent for transport in self.transports)
+
+    @property
+    def bytes(self):
+        return sum(transport.bytes for transport in self.transports)
+
+    @property
+    def packets(self):
+        return sum(transport.packets for transport in self.transports)
+
+    @property
+    def dropped(self):
+        return sum(transport.dropped for transport in self.transports)
+
+    @property
+    def backlog(self):
+        return sum(transport.backlog for transport in self.transports)
+
+
+# md5 like ketama: crc32 spreads the similar names of the ring points unevenly
+def hash32(name):
+    return struct.unpack('<I', hashlib.md5(name.encode('utf-8')).digest()[:4])[0]
+
+
+# "host:port", "[v6 address]:port", or "host" on the default port; for unix, the socket path
+def parse_destination(destination, port, kind='udp'):
+    if kind == 'unix':
+        return destination, None
+    if destination.startswith('['):
+        host, _, rest = destination[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else port
+    host, sep, rest = destination.rpartition(':')
+    if not sep:
+        return destination, port
+    return host, int(rest)
+
+
+TRANSPORTS = ['udp', 'tcp', 'unix']
+ROUTING = ['shard', 'mirror']
+
+
+# With more than one `destinations` ("host:port" strings), a Router over one transport each. An
+# IPv6 address is resolved as one; names stay IPv4, as "localhost" may well resolve to ::1 first.
+def make_transport(kind, host, port, mtu=1432, dns_ttl=300, suppress=None, buffer=10000, destinations=(),
+                   routing='shard'):
+    if len(destinations) > 1:
+        return Router([make_transport(kind, *parse_destination(destination, port, kind), mtu=mtu, dns_ttl=dns_ttl,
+                                      buffer=buffer) for destination in destinations], routing, suppress)
+    if destinations:
+        host, port = parse_destination(destinations[0], port, kind)
+    ipv6 = ':' in host
+    if kind == 'tcp':
+        return TCPTransport(host, port, mtu=mtu, dns_ttl=dns_ttl, ipv6=ipv6, suppress=suppress, buffer=buffer)
+    if kind == 'unix':
+        return UnixTransport(host, mtu=mtu, suppress=suppress)
+    return Transport(host, port, mtu=mtu, dns_ttl=dns_ttl, ipv6=ipv6, suppress=suppress)